@@ -2,11 +2,19 @@
 
 # Walk a directory tree and look for Git repositories that may have changes
 # that are either not committed or not pushed.
+#
+# Repositories are handed to a pool of worker threads as the walk finds them,
+# so their statuses are gathered concurrently with each other and with the
+# rest of the walk. Each costs a single "git status --porcelain=v2 --branch"
+# run, which also reports how far the current branch is ahead of its upstream
+# (as of the last fetch) for --unpushed. Results are reported in path order
+# once every repository has been checked.
 
 import argparse
+import json
 import os
-import subprocess
 import sys
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import Optional
 
 DOTFILES_DIR = os.getenv("DOTFILES")
@@ -15,65 +23,97 @@ if DOTFILES_DIR is None:
 sys.path.append(os.path.join(DOTFILES_DIR, "cli"))
 
 from lib.common.file_walker import FileWalker
+from lib.common.git import Git, GitStatus
 from lib.common.log import Log
 
 
-def run_command(cmd: list[str]) -> list[str]:
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+class RepositoryStatus:
+    def __init__(
+        self, dir: str, status: Optional[GitStatus], error: Optional[str] = None
+    ) -> None:
+        self.dir = dir
+        self.status = status
+        self.error = error
 
-    stdout, stderr = p.communicate()
-    if p.returncode != 0:
-        raise Exception(f"Command returned non-zero: returncode = {p.returncode}")
+    def has_uncommitted_changes(self) -> bool:
+        if self.status is None:
+            return False
+        return self.status.is_commit_required() or self.status.has_conflicts()
 
-    return list(
-        filter(
-            lambda line: line != "",
-            [line.strip() for line in stdout.split("\n")],
-        )
-    )
+    def has_unpushed_commits(self) -> bool:
+        if self.status is None:
+            return False
+        ahead = self.status.branch.ahead
+        return ahead is not None and ahead > 0
 
+    def to_dict(self) -> dict:
+        d: dict = {"repository": self.dir}
+        if self.status is not None:
+            d.update(self.status.to_dict())
+        if self.error is not None:
+            d["error"] = self.error
+        return d
 
-class GitRepoStatus:
-    def __init__(self, dir: str) -> None:
-        self._dir = dir
 
-        # TODO: Differentiate between staged and unstaged and add other file
-        # statuses
-        self.modified_files: list[str] = []
-        self.untracked_files: list[str] = []
+class RepositoryScanner:
+    def __init__(self, workers: Optional[int]) -> None:
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._pending: list[Future[RepositoryStatus]] = []
 
-        self.deleted_files: list[str] = []
+    def handle_dir(
+        self, dir: FileWalker.Directory
+    ) -> Optional[FileWalker.DirectoryHandlerResult]:
+        dir_path = dir.get_absolute_path()
+        if not is_git_repository(dir_path):
+            return None
 
-        lines = run_command(["git", "-C", self._dir, "status", "--short"])
+        self._pending.append(self._executor.submit(get_status, dir_path))
 
-        for line in lines:
-            file_status, file_path = line.split(" ", 1)
-            file_status = file_status.strip().lower()
-            file_path = file_path.strip().lower()
+        # Don't recurse into Git repositories
+        return FileWalker.DirectoryHandlerResult(skip=True)
 
-            if file_status == "m":
-                self.modified_files.append(file_path)
-            elif file_status == "d":
-                self.deleted_files.append(file_path)
-            elif file_status == "??":
-                self.untracked_files.append(file_path)
-            else:
-                raise Exception(
-                    f"Unknown file status; dir = {self._dir}, file_status = {file_status}"
-                )
-
-    def print_full_status(self) -> None:
-        subprocess.call(["git", "-C", self._dir, "status"])
+    # Waits for every repository found to be checked
+    def results(self) -> list[RepositoryStatus]:
+        results = [future.result() for future in self._pending]
+        self._executor.shutdown()
+        return sorted(results, key=lambda result: result.dir)
 
 
 def parse_args() -> argparse.Namespace:
-    parser = argparse.ArgumentParser(description="TODO")
+    parser = argparse.ArgumentParser(
+        description="Find Git repositories with uncommitted or unpushed changes"
+    )
     parser.add_argument(
         "directory",
         default=".",
         nargs="?",
         help="Top level directory to start scanning from",
     )
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=None,
+        help="Scan directories in parallel on this many threads",
+    )
+    parser.add_argument(
+        "-s",
+        "--status-workers",
+        type=int,
+        default=None,
+        help="Number of repositories to check at once (defaults to the CPU count + 4, up to 32)",
+    )
+    parser.add_argument(
+        "-u",
+        "--unpushed",
+        action="store_true",
+        help="Also report repositories whose current branch is ahead of its upstream",
+    )
+    parser.add_argument(
+        "--json",
+        action="store_true",
+        help="Print the repositories as a JSON array",
+    )
     return parser.parse_args()
 
 
@@ -81,52 +121,83 @@ def is_git_repository(dir: str) -> bool:
     return os.path.isdir(os.path.join(dir, ".git"))
 
 
-def has_uncommitted_changes(status: GitRepoStatus) -> bool:
-    if len(status.modified_files) > 0:
-        return True
-    if len(status.untracked_files) > 0:
-        return True
-    return False
-
+def get_status(dir: str) -> RepositoryStatus:
+    try:
+        return RepositoryStatus(dir, Git.status(dir))
+    except Exception as e:
+        return RepositoryStatus(dir, None, str(e))
 
-def get_status(dir: str) -> GitRepoStatus:
-    return GitRepoStatus(dir)
 
+def is_pending(result: RepositoryStatus, unpushed: bool) -> bool:
+    if result.error is not None or result.has_uncommitted_changes():
+        return True
+    return unpushed and result.has_unpushed_commits()
 
-def handle_git_repository(dir: str) -> None:
-    status = get_status(dir)
-    if not has_uncommitted_changes(status):
-        return
-
-    print("\n================================================================================")
-    print("Repository: " + dir + "\n")
-    status.print_full_status()
 
+def print_repository(result: RepositoryStatus) -> None:
+    print(
+        "\n================================================================================"
+    )
+    print("Repository: " + result.dir + "\n")
 
-def handle_dir(
-    dir: FileWalker.Directory,
-) -> Optional[FileWalker.DirectoryHandlerResult]:
-    dir_path = dir.get_absolute_path()
-    if not is_git_repository(dir_path):
-        return None
+    status = result.status
+    if status is None:
+        print(f"error: {result.error}")
+        return
 
-    handle_git_repository(dir_path)
+    branch = status.branch
+    if branch.head is None:
+        print(f"HEAD detached at {branch.oid}")
+    else:
+        print(f"On branch {branch.head}")
+    if branch.upstream is not None and branch.ahead is not None:
+        print(
+            f"Ahead of {branch.upstream} by {branch.ahead}, behind by {branch.behind}"
+        )
 
-    # Don't recurse into Git repositories
-    return FileWalker.DirectoryHandlerResult(skip=True)
+    # Entries changed in both the index and the work tree are in both lists
+    printed = set()
+    for entry in status.staged + status.unstaged + status.unmerged:
+        if id(entry) in printed:
+            continue
+        printed.add(id(entry))
+        if entry.orig_path is not None:
+            print(f"{entry.xy} {entry.orig_path} -> {entry.path}")
+        else:
+            print(f"{entry.xy} {entry.path}")
+    for path in status.untracked:
+        print(f"?? {path}")
 
 
 def main() -> None:
     args = parse_args()
 
     log_level = Log.parse_level("info")
-    Log.init("git_pending_changes.py", log_level)
+    # Keep stdout clean for the JSON
+    Log.init("git_pending_changes.py", log_level, stdout=not args.json)
+
+    scanner = RepositoryScanner(args.status_workers)
+    if args.workers is None:
+        FileWalker.walk(
+            os.path.realpath(args.directory),
+            file_handler=None,
+            directory_handler=scanner.handle_dir,
+        )
+    else:
+        FileWalker.walk_parallel(
+            os.path.realpath(args.directory),
+            file_handler=None,
+            directory_handler=scanner.handle_dir,
+            workers=args.workers,
+        )
 
-    FileWalker.walk(
-        os.path.realpath(args.directory),
-        file_handler=None,
-        directory_handler=handle_dir,
-    )
+    pending = [r for r in scanner.results() if is_pending(r, args.unpushed)]
+    if args.json:
+        print(json.dumps([r.to_dict() for r in pending], indent=4))
+        return
+
+    for result in pending:
+        print_repository(result)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+# Benchmark for FileWalker traversal throughput. Builds a synthetic directory
+# tree (1M entries by default) in a temporary directory, walks it and reports
+# entries/sec. An os.walk pass over the same tree is included as a baseline.
+#
+# With --memory it instead measures the memory retained by the nodes from
+# FileWalker.enumerate, compared to the eager node representation FileWalker
+# used previously.
+#
+# Example usage:
+#
+#     python cli/bench/file_walker.py --entries 1000000
+#     python cli/bench/file_walker.py --directory ~/src
+#     python cli/bench/file_walker.py --entries 500000 --memory
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Sized
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from lib.common.file_walker import FileWalker
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark FileWalker")
+    parser.add_argument(
+        "--entries",
+        type=int,
+        default=1000000,
+        help="Total number of files and directories in the synthetic tree",
+    )
+    parser.add_argument(
+        "--fanout",
+        type=int,
+        default=100,
+        help="Number of entries per directory",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=8,
+        help="Number of threads to use for FileWalker.walk_parallel",
+    )
+    parser.add_argument(
+        "--memory",
+        action="store_true",
+        help="Measure memory retained by enumerated nodes instead of throughput",
+    )
+    parser.add_argument(
+        "--directory",
+        default=None,
+        help="Existing directory to walk instead of generating a tree",
+    )
+    return parser.parse_args()
+
+
+# Creates a tree of roughly `entries` files and directories where every
+# directory holds `fanout` entries. Returns the number of entries created.
+def create_tree(root: str, entries: int, fanout: int) -> int:
+    created = 0
+    pending = [root]
+    while created < entries and len(pending) > 0:
+        directory = pending.pop(0)
+        subdirectories = max(1, fanout // 10)
+        for i in range(fanout):
+            if created >= entries:
+                break
+            if i < subdirectories:
+                path = os.path.join(directory, f"d{i}")
+                os.mkdir(path)
+                pending.append(path)
+            else:
+                open(os.path.join(directory, f"f{i}"), "w").close()
+            created += 1
+
+    return created
+
+
+def bench(name: str, entries: int, fn: Callable[[], int]) -> None:
+    start = time.perf_counter()
+    count = fn()
+    elapsed = time.perf_counter() - start
+    print(
+        f"{name:<30} {count:>10} entries {elapsed:>8.3f}s "
+        f"{count / elapsed:>12.0f} entries/sec"
+    )
+    if count != entries:
+        print(f"  warning: expected {entries} entries")
+
+
+def bench_file_walker(root: str, workers: int) -> int:
+    count = 0
+
+    def on_entry(_: FileWalker.Node) -> None:
+        nonlocal count
+        count += 1
+
+    if workers == 0:
+        FileWalker.walk(root, file_handler=on_entry, directory_handler=on_entry)
+    else:
+        FileWalker.walk_parallel(
+            root, file_handler=on_entry, directory_handler=on_entry, workers=workers
+        )
+    return count
+
+
+def bench_os_walk(root: str) -> int:
+    count = 0
+    for _, directories, files in os.walk(root):
+        count += len(directories) + len(files)
+    return count
+
+
+# The node representation FileWalker used before nodes were made lazy; kept
+# here so the memory benchmark has something to compare against
+class EagerNode:
+    def __init__(self, root_directory: str, relative_path: str):
+        self._root = root_directory
+        self._dir = os.path.dirname(relative_path)
+        self._name = os.path.basename(relative_path)
+        self._path_absolute = os.path.join(self._root, relative_path)
+        self._path_relative = relative_path
+
+
+def enumerate_eager(root: str) -> list[EagerNode]:
+    base_path = root + "/"
+    nodes = []
+
+    def on_entry(node: FileWalker.Node) -> None:
+        path_rel = node.get_absolute_path().replace(base_path, "")
+        nodes.append(EagerNode(root, path_rel))
+
+    FileWalker.walk(
+        root, file_handler=on_entry, directory_handler=on_entry, reuse_nodes=True
+    )
+    return nodes
+
+
+def enumerate_lazy(root: str) -> list[FileWalker.Node]:
+    return FileWalker.enumerate(root).get_nodes()
+
+
+def bench_memory(name: str, fn: Callable[[], Sized]) -> None:
+    tracemalloc.start()
+    start = time.perf_counter()
+    nodes = fn()
+    elapsed = time.perf_counter() - start
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    mib = 1024 * 1024
+    print(
+        f"{name:<30} {len(nodes):>10} nodes {elapsed:>8.3f}s "
+        f"{retained / mib:>8.1f} MiB retained {peak / mib:>8.1f} MiB peak "
+        f"{retained / max(1, len(nodes)):>6.0f} B/node"
+    )
+
+
+def run_memory(root: str) -> None:
+    bench_memory("eager nodes (previous)", lambda: enumerate_eager(root))
+    bench_memory("FileWalker.enumerate", lambda: enumerate_lazy(root))
+
+
+def run(root: str, entries: int, workers: int) -> None:
+    bench("FileWalker.walk", entries, lambda: bench_file_walker(root, 0))
+    bench(
+        f"FileWalker.walk_parallel({workers})",
+        entries,
+        lambda: bench_file_walker(root, workers),
+    )
+    bench("os.walk (baseline)", entries, lambda: bench_os_walk(root))
+
+
+def main() -> None:
+    args = parse_args()
+
+    if args.directory is not None:
+        root = os.path.realpath(args.directory)
+        if args.memory:
+            run_memory(root)
+        else:
+            run(root, bench_os_walk(root), args.workers)
+        return
+
+    with tempfile.TemporaryDirectory(prefix="file_walker_bench.") as root:
+        print(f"creating synthetic tree in {root}")
+        start = time.perf_counter()
+        entries = create_tree(root, args.entries, args.fanout)
+        elapsed = time.perf_counter() - start
+        print(f"created {entries} entries in {elapsed:.3f}s")
+        if args.memory:
+            run_memory(root)
+        else:
+            run(root, entries, args.workers)
+
+
+if __name__ == "__main__":
+    main()
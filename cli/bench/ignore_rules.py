@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+# Benchmark for IgnoreRules. Matches a set of synthetic ignore patterns (100 by
+# default) against synthetic relative paths (200k by default), comparing the
+# compiled rules against calling re.match() once per pattern per path, which is
+# how fzf_cached_wsl used to apply its .fzfignore file.
+#
+# Example usage:
+#
+#     python cli/bench/ignore_rules.py --patterns 100 --paths 200000
+
+import argparse
+import os
+import random
+import re
+import sys
+import time
+from typing import Callable
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from lib.common.ignore_rules import IgnoreRules
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark IgnoreRules")
+    parser.add_argument(
+        "--patterns",
+        type=int,
+        default=100,
+        help="Number of ignore patterns",
+    )
+    parser.add_argument(
+        "--paths",
+        type=int,
+        default=200000,
+        help="Number of paths to match against the patterns",
+    )
+    return parser.parse_args()
+
+
+def generate_paths(count: int) -> list[str]:
+    rng = random.Random(0)
+    paths = []
+    for _ in range(count):
+        depth = rng.randint(1, 6)
+        parts = [f"dir{rng.randint(0, 200)}" for _ in range(depth - 1)]
+        parts.append(f"file{rng.randint(0, 1000)}.ext{rng.randint(0, 300)}")
+        paths.append("/".join(parts))
+    return paths
+
+
+def generate_regex_patterns(count: int) -> list[str]:
+    patterns = []
+    for i in range(count):
+        if i % 2 == 0:
+            patterns.append(f"^.*\\.ext{i}$")
+        else:
+            patterns.append(f"^dir{i}/")
+    return patterns
+
+
+def generate_glob_patterns(count: int) -> list[str]:
+    patterns = []
+    for i in range(count):
+        if i % 2 == 0:
+            patterns.append(f"*.ext{i}")
+        else:
+            patterns.append(f"/dir{i}/**")
+    return patterns
+
+
+def bench(name: str, paths: list[str], is_ignored: Callable[[str], bool]) -> None:
+    start = time.perf_counter()
+    ignored = 0
+    for path in paths:
+        if is_ignored(path):
+            ignored += 1
+    elapsed = time.perf_counter() - start
+    print(
+        f"{name:<28} {len(paths):>8} paths {elapsed:>8.3f}s "
+        f"{len(paths) / elapsed:>12.0f} paths/sec {ignored:>8} ignored"
+    )
+
+
+def main() -> None:
+    args = parse_args()
+    paths = generate_paths(args.paths)
+    regex_patterns = generate_regex_patterns(args.patterns)
+    glob_patterns = generate_glob_patterns(args.patterns)
+
+    def is_ignored_naive(path: str) -> bool:
+        for pattern in regex_patterns:
+            if re.match(pattern, path) is not None:
+                return True
+        return False
+
+    regex_rules = IgnoreRules.parse("\n".join(regex_patterns))
+    glob_rules = IgnoreRules.parse("syntax: glob\n" + "\n".join(glob_patterns))
+
+    print(f"{args.patterns} patterns, {args.paths} paths")
+    bench("re.match per pattern", paths, is_ignored_naive)
+    bench("IgnoreRules (regexp)", paths, lambda p: bool(regex_rules.match(p, False)))
+    bench("IgnoreRules (glob)", paths, lambda p: bool(glob_rules.match(p, False)))
+
+
+if __name__ == "__main__":
+    main()
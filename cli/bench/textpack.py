@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+# Benchmark for bin/textpack. Packs a synthetic tree of text files (256 MB by
+# default) and unpacks the result again, reporting the throughput and the peak
+# RSS of each textpack process. With --index, the pack is indexed and the time
+# taken to extract a single file from it is reported too. --workers and
+# --compress are passed through to pack. Pass --textpack to measure another
+# version of the script, e.g. one checked out from an older commit.
+#
+# Example usage:
+#
+#     python cli/bench/textpack.py --size-mb 1024
+
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+DOTFILES_DIR = os.path.dirname(
+    os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark textpack")
+    parser.add_argument(
+        "--size-mb",
+        type=int,
+        default=256,
+        help="Total size of the files to pack in MB",
+    )
+    parser.add_argument(
+        "--file-kb",
+        type=int,
+        default=256,
+        help="Size of each file in KB",
+    )
+    parser.add_argument(
+        "--textpack",
+        default=os.path.join(DOTFILES_DIR, "bin", "textpack"),
+        help="Path to the textpack script to benchmark",
+    )
+    parser.add_argument(
+        "--index",
+        action="store_true",
+        help="Pack with an index and time extracting a single file",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of files for pack to read in parallel",
+    )
+    parser.add_argument(
+        "--compress",
+        action="store_true",
+        help="Compress the pack",
+    )
+    parser.add_argument(
+        "--directory",
+        default=None,
+        help="Directory to create the files under (defaults to the temp directory)",
+    )
+    return parser.parse_args()
+
+
+def create_tree(root: str, size_mb: int, file_kb: int) -> int:
+    rng = random.Random(0)
+    words = [
+        "".join(rng.choices("abcdefghij", k=rng.randint(2, 10))) for _ in range(1000)
+    ]
+    lines = [" ".join(rng.choices(words, k=12)) + "\n" for _ in range(1000)]
+
+    total = 0
+    file_count = size_mb * 1024 // file_kb
+    for i in range(file_count):
+        directory = os.path.join(root, f"dir{i % 64}")
+        os.makedirs(directory, exist_ok=True)
+
+        # Write in small batches to keep our own RSS down, as a child process's
+        # peak RSS includes its parent's at the time it was forked
+        with open(os.path.join(directory, f"file{i}.txt"), "w") as f:
+            size = 0
+            while size < file_kb * 1024:
+                batch = rng.choices(lines, k=100)
+                f.writelines(batch)
+                size += sum(len(line) for line in batch)
+        total += size
+    return total
+
+
+# Runs a textpack command, returning the elapsed time in seconds and the peak
+# RSS of the process in MB
+def run(textpack: str, args: list[str]) -> tuple[float, float]:
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, textpack] + args, stdout=subprocess.DEVNULL
+    )
+    _, status, rusage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise Exception(f"textpack {args[0]} failed with code {process.returncode}")
+    # ru_maxrss is in KB on Linux
+    return elapsed, rusage.ru_maxrss / 1024
+
+
+def report(name: str, size: int, elapsed: float, rss_mb: float) -> None:
+    throughput = size / (1024 * 1024) / elapsed
+    print(
+        f"{name:<8} {elapsed:8.3f}s {throughput:10.1f} MB/s {rss_mb:10.1f} MB peak RSS"
+    )
+
+
+def main() -> None:
+    args = parse_args()
+    root = tempfile.mkdtemp(prefix="bench_textpack_", dir=args.directory)
+    try:
+        src = os.path.join(root, "src")
+        size = create_tree(src, args.size_mb, args.file_kb)
+        print(f"Created {size / (1024 * 1024):.0f} MB of files under {src}")
+
+        pack_file = os.path.join(root, "pack.txt")
+        pack_args = ["pack", src, pack_file]
+        if args.index:
+            pack_args.append("--index")
+        if args.compress:
+            pack_args.append("--compress")
+        if args.workers is not None:
+            pack_args += ["--workers", str(args.workers)]
+        elapsed, rss_mb = run(args.textpack, pack_args)
+        report("pack", size, elapsed, rss_mb)
+        print(f"{'':<8} pack is {os.path.getsize(pack_file) / (1024 * 1024):.1f} MB")
+
+        dst = os.path.join(root, "dst")
+        elapsed, rss_mb = run(args.textpack, ["unpack", pack_file, dst])
+        report("unpack", size, elapsed, rss_mb)
+
+        if args.index:
+            # The last file packed, so it's as far into the pack as it gets
+            file_count = args.size_mb * 1024 // args.file_kb
+            path = f"dir{(file_count - 1) % 64}/file{file_count - 1}.txt"
+            elapsed, rss_mb = run(args.textpack, ["extract", pack_file, path])
+            print(f"{'extract':<8} {elapsed * 1000:8.1f}ms {rss_mb:21.1f} MB peak RSS")
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
@@ -89,6 +89,13 @@ def add_fd_parser(parent: argparse.ArgumentParser) -> None:
     cmd_parser_edit.set_defaults(func=cmd_edit)
 
     cmd_parser_update = subparsers.add_parser("update", help="Update the registry")
+    cmd_parser_update.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=None,
+        help="Scan directories in parallel on this many threads",
+    )
     cmd_parser_update.set_defaults(func=cmd_update)
 
 
@@ -162,7 +169,7 @@ def cmd_update(args: argparse.Namespace) -> None:
 
         git_repositories = []
         for path in config["update"]["git_search_paths"]:
-            git_repositories += locate_git_repositories(path)
+            git_repositories += locate_git_repositories(path, args.workers)
 
         for git_repository in git_repositories:
             key = git_repository.replace(home(), "~")
@@ -172,7 +179,7 @@ def cmd_update(args: argparse.Namespace) -> None:
     Registry.store(entries)
 
 
-def locate_git_repositories(path) -> None:
+def locate_git_repositories(path: str, workers: Optional[int] = None) -> list[str]:
     if path.startswith("~/"):
         path = f"{home()}/{path[2:]}"
     if "$HOME" in path:
@@ -187,10 +194,18 @@ def locate_git_repositories(path) -> None:
             git_repositories.append(dir.get_absolute_path())
             return FileWalker.DirectoryHandlerResult(skip=True)
 
-    FileWalker.walk(
-        os.path.realpath(path),
-        file_handler=None,
-        directory_handler=handle_dir,
-    )
+    if workers is None:
+        FileWalker.walk(
+            os.path.realpath(path),
+            file_handler=None,
+            directory_handler=handle_dir,
+        )
+    else:
+        FileWalker.walk_parallel(
+            os.path.realpath(path),
+            file_handler=None,
+            directory_handler=handle_dir,
+            workers=workers,
+        )
 
     return git_repositories
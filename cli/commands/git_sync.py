@@ -5,7 +5,7 @@ import json
 import random
 import string
 
-from lib.common.git import Git, GitCommit
+from lib.common.git import Git, GitCommit, GitSession
 from lib.common.log import Log
 from lib.common.typing import StringOrNone
 
@@ -39,44 +39,12 @@ def generate_temporary_branch_name(length: int = 8):
     return f"temp-{random_string}"
 
 
-# Find the most recent matching commit between the local and remote
-# repositories. Returns the index into both arrays of that commit.
-def find_common_commit(
-    local_commits: list[GitCommit], remote_commits: list[GitCommit]
-) -> tuple[int, int]:
-    remote_commits_dict = {}
-    for i in range(len(remote_commits)):
-        remote_commit = remote_commits[i]
-        remote_commits_dict[remote_commit.hash] = i
-
-    local_commit_index = None
-    remote_commit_index = None
-
-    for i in range(len(local_commits)):
-        local_commit = local_commits[i]
-        remote_commit_index = remote_commits_dict.get(local_commit.hash)
-        if remote_commit_index is None:
-            continue
-        local_commit_index = i
-        remote_commit_index = remote_commit_index
-        break
-
-    if remote_commit_index is None:
-        raise Exception(
-            "Failed to find a common commit between the local and remote repositories"
-        )
-
-    common_commit = local_commits[local_commit_index]
-    Log.info(
-        "common commit found",
-        {"hash": common_commit.hash, "message": common_commit.message},
-    )
-
-    return local_commit_index, remote_commit_index
-
-
-def resolve_local_changes(current_branch: str, dry_run: bool) -> StringOrNone:
-    git_status = Git.status()
+def resolve_local_changes(
+    session: GitSession, current_branch: str, dry_run: bool
+) -> StringOrNone:
+    git_status = session.status()
+    if git_status.has_conflicts():
+        raise Exception("Local changes have merge conflicts that need resolving")
 
     Log.info("Checking if there are local changes that need to be committed")
     if not git_status.is_commit_required():
@@ -93,12 +61,12 @@ def resolve_local_changes(current_branch: str, dry_run: bool) -> StringOrNone:
 
     Log.info("Creating temporary branch")
     if not dry_run:
-        Git.create_branch(temp_branch)
+        session.create_branch(temp_branch)
     Log.info("Temporary branch created")
 
     Log.info("Checking out temporary branch")
     if not dry_run:
-        Git.checkout(temp_branch)
+        session.checkout(temp_branch)
     Log.info("Temporary branch checked out")
 
     # If there are unstaged modified or untracked files, we need to stage them
@@ -106,75 +74,100 @@ def resolve_local_changes(current_branch: str, dry_run: bool) -> StringOrNone:
     if git_status.is_add_required():
         Log.info("There are unstaged modifications or additions, staging changes")
         if not dry_run:
-            Git.add_all()
+            session.add_all()
     else:
         Log.info("There are no unstaged changes that need to be staged")
 
     Log.info("There are staged modifications or additions, commiting changes")
     if not dry_run:
-        Git.commit("[Auto] Syncing local changes with remote")
+        session.commit("[Auto] Syncing local changes with remote")
     Log.info("Changes were committed")
 
     Log.info("Identifying hash of the temporary commit")
     temp_commit_hash = "abcd1234abcd1234abcd1234abcd1234abcd1234"
     if not dry_run:
-        temp_commit_hash = Git.get_commits(limit=1)[0].hash
+        head_hash = session.resolve("HEAD")
+        if head_hash is None:
+            raise Exception("Failed to identify the temporary commit")
+        temp_commit_hash = head_hash
     Log.info(f"Temporary commit hash = {temp_commit_hash}")
 
-    Log.info(f"Checking out the original branch ({current_branch.name})")
+    Log.info(f"Checking out the original branch ({current_branch})")
     if not dry_run:
-        Git.checkout(current_branch.name)
+        session.checkout(current_branch)
     Log.info(f"Checked out the original branch")
 
     return temp_commit_hash
 
 
 def cmd_git_sync(args: argparse.Namespace) -> None:
+    with GitSession() as session:
+        git_sync(session, args)
+
+
+def git_sync(session: GitSession, args: argparse.Namespace) -> None:
     Log.info("Identifying current branch")
-    current_branch = Git.get_current_branch()
+    current_branch = session.branch()
     Log.info(f"Current branch is {current_branch}")
 
-    remote = current_branch.tracking.split("/")[0]
+    if current_branch.head is None:
+        raise Exception("Can't sync a detached HEAD")
+    branch_name = current_branch.head
+    # The remote tracking ref, e.g. "origin/main", which may be for a branch
+    # with a different name than the local one
+    upstream = current_branch.upstream
 
     # If there are local changes that need to be committed, commit them into a
     # temp branch first.
-    temp_commit_hash = resolve_local_changes(current_branch, args.dry_run)
+    temp_commit_hash = resolve_local_changes(session, branch_name, args.dry_run)
 
-    Log.info("Fetching all changes from remotes")
-    Git.fetch_all()
+    if upstream is None:
+        Log.warn(
+            "Branch has no upstream, skipping the sync with remote",
+            {"branch": branch_name},
+        )
+        if temp_commit_hash is not None and not args.dry_run:
+            session.cherry_pick(temp_commit_hash)
+        return
 
-    # Get the commits from both the local and remote repository
-    local_commits = Git.get_commits()
-    remote_commits = Git.get_commits(f"{remote}/{current_branch.name}")
+    remote, _, remote_branch = upstream.partition("/")
 
-    if args.verbose:
-        print_commits(local_commits)
-        print_commits(remote_commits)
+    Log.info("Fetching all changes from remotes")
+    session.fetch_all()
 
-    # Find the most recent matching commit between the local and remote
-    local_commit_index, remote_commit_index = find_common_commit(
-        local_commits, remote_commits
+    # Find where the local and remote histories diverged. Only the commits
+    # since then are walked, so this doesn't depend on the history's length.
+    common_hash = session.merge_base("HEAD", upstream)
+    common_commit = None if common_hash is None else session.get_commit(common_hash)
+    if common_commit is None:
+        raise Exception(
+            "Failed to find a common commit between the local and remote repositories"
+        )
+    Log.info(
+        "common commit found",
+        {"hash": common_commit.hash, "message": common_commit.message},
     )
 
-    print(
-        local_commit_index,
-        remote_commit_index,
-        len(local_commits),
-        len(remote_commits),
+    local_ahead_count, remote_ahead_count = session.count_ahead_behind("HEAD", upstream)
+    Log.info(
+        "compared with remote",
+        {"local_ahead": local_ahead_count, "remote_ahead": remote_ahead_count},
     )
 
-    # Get the number of commits the local repository has that the remote is
+    if args.verbose:
+        print_commits(Git.get_commits(f"{upstream}..HEAD"))
+        print_commits(Git.get_commits(f"HEAD..{upstream}"))
+
+    # Check whether the local repository has commits that the remote is
     # missing
     push_required = temp_commit_hash is not None
-    local_ahead_count = local_commit_index
     if local_ahead_count > 0:
         Log.info("Local repository has commits that the remote is missing")
         push_required = True
 
-    # Get the number of commits the remote repository has that the local is
+    # Check whether the remote repository has commits that the local is
     # missing
     pull_required = False
-    remote_ahead_count = remote_commit_index
     if remote_ahead_count > 0:
         Log.info("Remote has commits that the local repository is missing")
         pull_required = True
@@ -183,18 +176,18 @@ def cmd_git_sync(args: argparse.Namespace) -> None:
     if pull_required:
         Log.info("pulling from remote")
         if not args.dry_run:
-            Git.pull(remote, current_branch.name, rebase=True)
+            session.pull(remote, remote_branch, rebase=True)
 
     # If we committed local changes to a temp branch, cherry-pick that back in
     if temp_commit_hash is not None:
         Log.info("cherry-picking temporary commit")
         if not args.dry_run:
-            Git.cherry_pick(temp_commit_hash)
+            session.cherry_pick(temp_commit_hash)
 
     if push_required:
         Log.info("pushing to remote")
         if not args.dry_run:
-            Git.push(remote, current_branch.name)
+            session.push(remote, f"{branch_name}:{remote_branch}")
 
 
 def print_commits(commits: list[GitCommit]):
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import argparse
+import os
 
 from lib.common.linter import Linter
 
@@ -15,8 +16,56 @@ def add_lint_parser(subparsers: argparse._SubParsersAction) -> None:
         nargs="*",
         help="The files to lint; if omitted, all files are linted",
     )
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of files to lint in parallel (defaults to the CPU count)",
+    )
+    parser.add_argument(
+        "-b",
+        "--batch",
+        action="store_true",
+        help="Run each tool once over all of the files rather than once per file",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Check every file, ignoring and not updating the lint cache",
+    )
+    parser.add_argument(
+        "-D",
+        "--daemon",
+        action="store_true",
+        help="Type check with a mypy daemon that's kept running between runs",
+    )
+    parser.add_argument(
+        "--stop-daemon",
+        action="store_true",
+        help="Stop the mypy daemon instead of linting",
+    )
+    changed = parser.add_mutually_exclusive_group()
+    changed.add_argument(
+        "-c",
+        "--changed",
+        action="store_true",
+        help="Only lint the Python files with uncommitted changes, or untracked",
+    )
+    changed.add_argument(
+        "--since",
+        metavar="REF",
+        help="Only lint the Python files changed since the commit, or untracked",
+    )
     parser.set_defaults(func=cmd_lint)
 
 
 def cmd_lint(args: argparse.Namespace) -> None:
-    Linter.lint(args.files)
+    if args.stop_daemon:
+        Linter.stop_daemon()
+        return
+
+    since = "HEAD" if args.changed else args.since
+    Linter.lint(
+        args.files, args.workers, args.batch, not args.no_cache, since, args.daemon
+    )
@@ -4,7 +4,7 @@ import argparse
 import os
 
 from lib.common.dir import Dir
-from lib.common.git import Git
+from lib.common.git import GitSession
 
 
 def add_status_parser(subparsers: argparse._SubParsersAction) -> None:
@@ -18,19 +18,28 @@ def add_status_parser(subparsers: argparse._SubParsersAction) -> None:
 def cmd_status(args: argparse.Namespace) -> None:
     os.chdir(Dir.dot())
 
-    branches = Git.get_branches()
-    for branch in branches:
-        if branch.is_current:
-            print(f"On branch: {branch.name}")
+    # Everything comes from a single "git status" run
+    with GitSession() as session:
+        status = session.status()
 
-    # TODO: Check if there are unstaged changes
-    print("Unstaged changes: TODO")
+    branch = status.branch
+    if branch.head is not None:
+        print(f"On branch: {branch.head}")
+    else:
+        print(f"HEAD detached at: {branch.oid}")
 
-    # TODO: Check if there are staged but uncommitted changes
-    print("Uncommitted changes: TODO")
+    unstaged = len(status.unstaged) + len(status.untracked)
+    print(f"Unstaged changes: {unstaged}")
 
-    # TODO: Check if local repository is missing commits from remote
-    print("Behind upstream: TODO")
+    print(f"Uncommitted changes: {len(status.staged)}")
 
-    # TODO: Check if remote repository is missing commits from local
-    print("Ahead of upstream: TODO")
+    if status.has_conflicts():
+        print(f"Unmerged paths: {len(status.unmerged)}")
+
+    # As of the last fetch
+    if branch.ahead is None or branch.behind is None:
+        print("Behind upstream: no upstream")
+        print("Ahead of upstream: no upstream")
+    else:
+        print(f"Behind upstream: {branch.behind}")
+        print(f"Ahead of upstream: {branch.ahead}")
@@ -21,8 +21,27 @@ def add_tidy_parser(subparsers: argparse._SubParsersAction) -> None:
         action="store_true",
         help="Print tidy actions without running them",
     )
+    parser.add_argument(
+        "-b",
+        "--batch",
+        action="store_true",
+        help="Run each tool once over all of the files rather than once per file",
+    )
+    changed = parser.add_mutually_exclusive_group()
+    changed.add_argument(
+        "-c",
+        "--changed",
+        action="store_true",
+        help="Only tidy the Python files with uncommitted changes, or untracked",
+    )
+    changed.add_argument(
+        "--since",
+        metavar="REF",
+        help="Only tidy the Python files changed since the commit, or untracked",
+    )
     parser.set_defaults(func=cmd_tidy)
 
 
 def cmd_tidy(args: argparse.Namespace) -> None:
-    Linter.tidy(args.files, args.dry_run)
+    since = "HEAD" if args.changed else args.since
+    Linter.tidy(args.files, args.dry_run, args.batch, since)
@@ -2,46 +2,86 @@
 
 import json
 import os
-from typing import Callable, Optional
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from enum import Enum
+from typing import Callable, Generator, Optional
 
 from lib.common.log import Log
 
 
+class EntryType(Enum):
+    FILE = 1
+    DIRECTORY = 2
+    SYMLINK = 3
+
+
+# How a walk treats symbolic links:
+# - FOLLOW: Symlinks are resolved and reported as the file or directory they
+#   point to; symlinked directories are descended into. Broken symlinks are
+#   ignored. This costs a stat() call per symlink.
+# - NO_FOLLOW: Symlinks are ignored without being resolved.
+# - REPORT: Symlinks are reported as Symlink nodes without being resolved.
+#   Handlers can call stat() on the node if they need to know the target.
+class SymlinkPolicy(Enum):
+    FOLLOW = 1
+    NO_FOLLOW = 2
+    REPORT = 3
+
+
 class FileWalker:
+    # Nodes wrap the os.DirEntry that os.scandir() produced along with the
+    # root directory (shared by every node in a walk). The relative path and
+    # parent directory are sliced out of the entry's path only when asked for,
+    # and stat() results are cached by the entry so they cost at most one
+    # syscall per node.
     class Node:
-        def __init__(self, root_directory: str, relative_path: str):
-            self._root = root_directory
-            self._dir = os.path.dirname(relative_path)
-            self._name = os.path.basename(relative_path)
+        __slots__ = ("_root", "_dir_entry")
 
-            # For optimization purposes, store these off to avoid further allocations
-            self._path_absolute = os.path.join(self._root, relative_path)
-            self._path_relative = relative_path
+        def __init__(self, root: str, dir_entry: os.DirEntry[str]) -> None:
+            self._root = root
+            self._dir_entry = dir_entry
 
         def get_root(self) -> str:
             return self._root
 
         def get_name(self) -> str:
-            return self._name
+            return self._dir_entry.name
+
+        def get_dir_entry(self) -> os.DirEntry[str]:
+            return self._dir_entry
+
+        def stat(self, follow_symlinks: bool = True) -> os.stat_result:
+            return self._dir_entry.stat(follow_symlinks=follow_symlinks)
+
+        def get_dir(self) -> str:
+            return os.path.dirname(self.get_relative_path())
 
         def get_relative_path(self) -> str:
-            return self._path_relative
+            prefix_len = len(self._root)
+            if not self._root.endswith("/"):
+                prefix_len += 1
+            return self._dir_entry.path[prefix_len:]
 
         def get_absolute_path(self) -> str:
-            return self._path_absolute
+            return self._dir_entry.path
 
         def __str__(self) -> str:
             return json.dumps(
-                {"root": self._root, "dir": self._dir, "name": self._name}
+                {"root": self._root, "dir": self.get_dir(), "name": self.get_name()}
             )
 
     class File(Node):
-        def __init__(self, root: str, file: str):
-            super().__init__(root, file)
+        __slots__ = ()
 
     class Directory(Node):
-        def __init__(self, root: str, directory: str):
-            super().__init__(root, directory)
+        __slots__ = ()
+
+    class Symlink(Node):
+        __slots__ = ()
+
+        def get_target(self) -> str:
+            return os.readlink(self._dir_entry.path)
 
     class DirectoryHandlerResult:
         def __init__(self, halt: bool = False, skip: bool = False) -> None:
@@ -52,6 +92,10 @@ class FileWalker:
         def __init__(self, halt: bool = False) -> None:
             self.halt = halt
 
+    class SymlinkHandlerResult:
+        def __init__(self, halt: bool = False) -> None:
+            self.halt = halt
+
     class Enumeration:
         def __init__(self) -> None:
             self._files: list["FileWalker.File"] = []
@@ -78,6 +122,8 @@ class FileWalker:
 
     FileHandler = Optional[Callable[[File], Optional[FileHandlerResult]]]
     DirectoryHandler = Optional[Callable[[Directory], Optional[DirectoryHandlerResult]]]
+    SymlinkHandler = Optional[Callable[[Symlink], Optional[SymlinkHandlerResult]]]
+    PruneHandler = Optional[Callable[[Directory], bool]]
 
     class Context:
         def __init__(
@@ -85,67 +131,212 @@ class FileWalker:
             root: str,
             file_handler: "FileWalker.FileHandler" = None,
             directory_handler: "FileWalker.DirectoryHandler" = None,
+            symlink_handler: "FileWalker.SymlinkHandler" = None,
+            symlink_policy: SymlinkPolicy = SymlinkPolicy.FOLLOW,
+            reuse_nodes: bool = False,
         ):
             self.root = root
             self.file_handler = file_handler
             self.directory_handler = directory_handler
+            self.symlink_handler = symlink_handler
+            self.symlink_policy = symlink_policy
+            self.reuse_nodes = reuse_nodes
             self.halt = False
-            self.base_path = root + "/"
 
+            self._file: Optional[FileWalker.File] = None
+            self._directory: Optional[FileWalker.Directory] = None
+            self._symlink: Optional[FileWalker.Symlink] = None
+
+        def file(self, dir_entry: os.DirEntry[str]) -> "FileWalker.File":
+            if not self.reuse_nodes:
+                return FileWalker.File(self.root, dir_entry)
+            if self._file is None:
+                self._file = FileWalker.File(self.root, dir_entry)
+            self._file._dir_entry = dir_entry
+            return self._file
+
+        def directory(self, dir_entry: os.DirEntry[str]) -> "FileWalker.Directory":
+            if not self.reuse_nodes:
+                return FileWalker.Directory(self.root, dir_entry)
+            if self._directory is None:
+                self._directory = FileWalker.Directory(self.root, dir_entry)
+            self._directory._dir_entry = dir_entry
+            return self._directory
+
+        def symlink(self, dir_entry: os.DirEntry[str]) -> "FileWalker.Symlink":
+            if not self.reuse_nodes:
+                return FileWalker.Symlink(self.root, dir_entry)
+            if self._symlink is None:
+                self._symlink = FileWalker.Symlink(self.root, dir_entry)
+            self._symlink._dir_entry = dir_entry
+            return self._symlink
+
+    # Walks a directory tree depth-first, invoking the handlers for each file,
+    # directory and (depending on the symlink policy) symlink found.
+    #
+    # If reuse_nodes is set, one node object per node type is updated in place
+    # and passed to every handler call instead of allocating a node per entry;
+    # handlers must not hold on to nodes beyond the call in that case.
     @staticmethod
     def walk(
         directory: str,
         file_handler: "FileWalker.FileHandler" = None,
         directory_handler: "FileWalker.DirectoryHandler" = None,
+        reuse_nodes: bool = False,
+        symlink_policy: SymlinkPolicy = SymlinkPolicy.FOLLOW,
+        symlink_handler: "FileWalker.SymlinkHandler" = None,
     ) -> None:
-        ctx = FileWalker.Context(directory, file_handler, directory_handler)
-        FileWalker._walk(ctx, FileWalker.Directory(directory, ""))
+        ctx = FileWalker.Context(
+            directory,
+            file_handler,
+            directory_handler,
+            symlink_handler,
+            symlink_policy,
+            reuse_nodes,
+        )
+        FileWalker._walk(ctx)
 
     @staticmethod
-    def _walk(ctx: Context, directory: Directory) -> None:
-        dir_entries = os.scandir(path=directory.get_absolute_path())
-        for dir_entry in dir_entries:
-            if ctx.halt:
-                break
-            path_rel = dir_entry.path.replace(ctx.base_path, "")
-            if dir_entry.is_dir(follow_symlinks=True):
-                FileWalker._handle_dir(ctx, FileWalker.Directory(ctx.root, path_rel))
-            elif dir_entry.is_file(follow_symlinks=True):
-                FileWalker._handle_file(ctx, FileWalker.File(ctx.root, path_rel))
-            elif dir_entry.is_symlink():
-                Log.debug(
-                    "encountered symlink directory entry with non-existant target"
-                )
-            else:
-                Log.warn(
-                    "encountered directory entry of unknown type",
-                    [("path", dir_entry.path)],
-                )
+    def _walk(ctx: Context) -> None:
+        # Depth-first traversal driven by an explicit stack of open scandir
+        # iterators instead of recursion so that very deep trees can't exhaust
+        # the interpreter stack. Entries are visited in the same order as a
+        # recursive walk would visit them. Each iterator is closed as soon as
+        # its directory is exhausted, or when the walk halts or raises.
+        stack = [os.scandir(path=ctx.root)]
+        try:
+            while len(stack) > 0 and not ctx.halt:
+                dir_entry = next(stack[-1], None)
+                if dir_entry is None:
+                    stack.pop().close()
+                    continue
+                entry_type = FileWalker._entry_type(dir_entry, ctx.symlink_policy)
+                if entry_type == EntryType.DIRECTORY:
+                    if FileWalker._handle_dir(ctx, ctx.directory(dir_entry)):
+                        stack.append(os.scandir(dir_entry.path))
+                elif entry_type == EntryType.FILE and ctx.file_handler is not None:
+                    FileWalker._handle_file(ctx, ctx.file(dir_entry))
+                elif (
+                    entry_type == EntryType.SYMLINK and ctx.symlink_handler is not None
+                ):
+                    FileWalker._handle_symlink(ctx, ctx.symlink(dir_entry))
+        finally:
+            for dir_entries in stack:
+                dir_entries.close()
+
+    # Same as walk() but the os.scandir() calls, and the stat calls needed to
+    # classify each entry, are spread across a pool of worker threads so that
+    # many directories are read at once. This helps most on high latency file
+    # systems like WSL's 9p mounts or NFS.
+    #
+    # Handlers are always invoked on the calling thread so they don't need to
+    # be thread-safe. A directory's handler is invoked before that directory is
+    # scanned, so skip and halt behave the same as they do for walk(). Entries
+    # are visited breadth-first rather than depth-first, though the order is
+    # still deterministic.
+    @staticmethod
+    def walk_parallel(
+        directory: str,
+        file_handler: "FileWalker.FileHandler" = None,
+        directory_handler: "FileWalker.DirectoryHandler" = None,
+        workers: int = 8,
+        symlink_policy: SymlinkPolicy = SymlinkPolicy.FOLLOW,
+        symlink_handler: "FileWalker.SymlinkHandler" = None,
+    ) -> None:
+        ctx = FileWalker.Context(
+            directory, file_handler, directory_handler, symlink_handler, symlink_policy
+        )
 
+        def scan(path: str) -> list[tuple[os.DirEntry[str], EntryType]]:
+            return FileWalker._scan(path, symlink_policy)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending: deque[Future[list[tuple[os.DirEntry[str], EntryType]]]] = deque()
+            pending.append(executor.submit(scan, directory))
+            try:
+                while len(pending) > 0 and not ctx.halt:
+                    for dir_entry, entry_type in pending.popleft().result():
+                        if ctx.halt:
+                            break
+                        if entry_type == EntryType.DIRECTORY:
+                            if FileWalker._handle_dir(ctx, ctx.directory(dir_entry)):
+                                pending.append(executor.submit(scan, dir_entry.path))
+                        elif entry_type == EntryType.FILE:
+                            FileWalker._handle_file(ctx, ctx.file(dir_entry))
+                        else:
+                            FileWalker._handle_symlink(ctx, ctx.symlink(dir_entry))
+            finally:
+                # Don't start scanning directories whose results will never be
+                # consumed; scans that are already running are just waited on
+                for future in pending:
+                    future.cancel()
+
+    # Reads a single directory on a worker thread and returns each entry in it
+    # along with its type
     @staticmethod
-    def _handle_dir(ctx: Context, directory: Directory) -> None:
+    def _scan(
+        path: str, symlink_policy: SymlinkPolicy
+    ) -> list[tuple[os.DirEntry[str], EntryType]]:
+        entries = []
+        with os.scandir(path=path) as dir_entries:
+            for dir_entry in dir_entries:
+                entry_type = FileWalker._entry_type(dir_entry, symlink_policy)
+                if entry_type is not None:
+                    entries.append((dir_entry, entry_type))
+        return entries
+
+    # Classifies a directory entry. On file systems that report d_type from
+    # getdents (i.e. nearly all of them) this doesn't make any syscalls unless
+    # the entry is a symlink that has to be followed.
+    @staticmethod
+    def _entry_type(
+        dir_entry: os.DirEntry[str], symlink_policy: SymlinkPolicy
+    ) -> Optional[EntryType]:
+        if dir_entry.is_symlink():
+            if symlink_policy == SymlinkPolicy.REPORT:
+                return EntryType.SYMLINK
+            if symlink_policy == SymlinkPolicy.NO_FOLLOW:
+                return None
+            if dir_entry.is_dir():
+                return EntryType.DIRECTORY
+            if dir_entry.is_file():
+                return EntryType.FILE
+            Log.debug("encountered symlink directory entry with non-existant target")
+            return None
+
+        if dir_entry.is_dir(follow_symlinks=False):
+            return EntryType.DIRECTORY
+        if dir_entry.is_file(follow_symlinks=False):
+            return EntryType.FILE
+        Log.warn(
+            "encountered directory entry of unknown type",
+            {"path": dir_entry.path},
+        )
+        return None
+
+    # Returns True if the walk should descend into the directory
+    @staticmethod
+    def _handle_dir(ctx: Context, directory: Directory) -> bool:
         # If no handler was provided, keep walking
         if ctx.directory_handler is None:
-            FileWalker._walk(ctx, directory)
-            return
+            return True
 
         # If handler didn't return a result, keep walking
         result = ctx.directory_handler(directory)
         if result is None:
-            FileWalker._walk(ctx, directory)
-            return
+            return True
 
         # If handler requested to halt, stop immediately
         ctx.halt = result.halt
         if ctx.halt:
-            return
+            return False
 
-        # If handler requested to skip, do nothin
+        # If handler requested to skip, don't descend
         if result.skip:
-            return
+            return False
 
         # Handler provided a result but didn't request to halt or skip
-        FileWalker._walk(ctx, directory)
+        return True
 
     @staticmethod
     def _handle_file(ctx: Context, file: File) -> None:
@@ -161,6 +352,20 @@ class FileWalker:
         # If handler requested to halt, stop immediately
         ctx.halt = result.halt
 
+    @staticmethod
+    def _handle_symlink(ctx: Context, symlink: Symlink) -> None:
+        # If no handler was provided, there's nothing to do
+        if ctx.symlink_handler is None:
+            return
+
+        # If handler didn't return a result, keep walking
+        result = ctx.symlink_handler(symlink)
+        if result is None:
+            return
+
+        # If handler requested to halt, stop immediately
+        ctx.halt = result.halt
+
     @staticmethod
     def enumerate(
         directory: str, files: bool = True, directories: bool = True
@@ -180,3 +385,61 @@ class FileWalker:
             directory, file_handler=file_handler, directory_handler=directory_handler
         )
         return enumeration
+
+    # Lazily yields the files and directories (and symlinks, if the symlink
+    # policy is REPORT) under a directory in the same order as walk() visits
+    # them, so memory stays flat no matter how large the tree is and callers
+    # can start consuming results immediately.
+    #
+    # A directory can be pruned, i.e. not descended into, either by passing a
+    # prune handler that returns True for it or by sending a truthy value into
+    # the generator right after the directory was yielded. In the latter case
+    # send() returns the pruned directory so the next iteration of a for loop
+    # still sees the next entry:
+    #
+    #     walker = FileWalker.iter(path)
+    #     for node in walker:
+    #         if node.get_name() == ".git":
+    #             walker.send(True)
+    #
+    # Breaking out of the loop (or closing the generator) closes any open
+    # scandir iterators.
+    @staticmethod
+    def iter(
+        directory: str,
+        files: bool = True,
+        directories: bool = True,
+        prune: "FileWalker.PruneHandler" = None,
+        symlink_policy: SymlinkPolicy = SymlinkPolicy.FOLLOW,
+    ) -> Generator["FileWalker.Node", Optional[bool], None]:
+        stack = [os.scandir(path=directory)]
+        try:
+            while len(stack) > 0:
+                dir_entry = next(stack[-1], None)
+                if dir_entry is None:
+                    stack.pop().close()
+                    continue
+                entry_type = FileWalker._entry_type(dir_entry, symlink_policy)
+                if entry_type == EntryType.DIRECTORY:
+                    subdirectory = FileWalker.Directory(directory, dir_entry)
+                    if directories and (yield subdirectory):
+                        # Acknowledge the send() so the caller's loop doesn't
+                        # lose the next entry
+                        yield subdirectory
+                        continue
+                    if prune is not None and prune(subdirectory):
+                        continue
+                    stack.append(os.scandir(dir_entry.path))
+                elif entry_type == EntryType.FILE and files:
+                    file = FileWalker.File(directory, dir_entry)
+                    if (yield file):
+                        # Pruning a file is a no-op but the send() still needs
+                        # to be acknowledged
+                        yield file
+                elif entry_type == EntryType.SYMLINK:
+                    symlink = FileWalker.Symlink(directory, dir_entry)
+                    if (yield symlink):
+                        yield symlink
+        finally:
+            for dir_entries in stack:
+                dir_entries.close()
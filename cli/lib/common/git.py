@@ -1,19 +1,28 @@
 #!/usr/bin/env python
 
 import json
+import os
 import subprocess
+import tempfile
+from typing import IO, Iterator, Optional
 
 from lib.common.log import Log
 
 
+# Pass separator="\0" for commands run with -z, whose output can't be split on
+# newlines as paths may contain them
 def _execute_git_command(
-    cmd: list[str], strip: bool = True, filter_empty: bool = True
-) -> str:
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+    cmd: list[str],
+    strip: bool = True,
+    filter_empty: bool = True,
+    cwd: Optional[str] = None,
+    separator: str = "\n",
+) -> list[str]:
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True, cwd=cwd)
     stdout, _ = p.communicate()
     if p.returncode != 0:
         raise Exception("Git command failed: {}".format(" ".join(cmd)))
-    lines = stdout.split("\n")
+    lines = stdout.split(separator)
     if strip:
         lines = [l.strip() for l in lines]
     if filter_empty:
@@ -21,64 +30,180 @@ def _execute_git_command(
     return lines
 
 
+# The branch headers of "git status --porcelain=v2 --branch". ahead and behind
+# are None when there's no upstream (or it doesn't exist).
+class GitBranchStatus:
+    def __init__(self) -> None:
+        self.head: Optional[str] = None
+        self.oid: Optional[str] = None
+        self.upstream: Optional[str] = None
+        self.ahead: Optional[int] = None
+        self.behind: Optional[int] = None
+
+    def is_detached(self) -> bool:
+        return self.head is None
+
+    def _parse_header(self, line: str) -> None:
+        key, _, value = line[len("# ") :].partition(" ")
+        if key == "branch.oid":
+            self.oid = None if value == "(initial)" else value
+        elif key == "branch.head":
+            self.head = None if value == "(detached)" else value
+        elif key == "branch.upstream":
+            self.upstream = value
+        elif key == "branch.ab":
+            ahead, behind = value.split(" ")
+            self.ahead = int(ahead)
+            self.behind = -int(behind)
+
+    def to_dict(self) -> dict:
+        return {
+            "head": self.head,
+            "oid": self.oid,
+            "upstream": self.upstream,
+            "ahead": self.ahead,
+            "behind": self.behind,
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), indent=4)
+
+    def __str__(self) -> str:
+        return self.to_json()
+
+
+# A tracked path with changes, from a "1", "2" or "u" record of
+# "git status --porcelain=v2". xy is the two letter status: the index's
+# change from HEAD then the work tree's change from the index, with "." for
+# unchanged. orig_path is the path the file was renamed or copied from.
+class GitStatusEntry:
+    __slots__ = ("xy", "path", "orig_path")
+
+    def __init__(self, xy: str, path: str, orig_path: Optional[str] = None) -> None:
+        self.xy = xy
+        self.path = path
+        self.orig_path = orig_path
+
+    def to_dict(self) -> dict:
+        d = {"xy": self.xy, "path": self.path}
+        if self.orig_path is not None:
+            d["orig_path"] = self.orig_path
+        return d
+
+
+# The status letters an ordinary, renamed or copied entry can have on either
+# side, and the letter pairs of an unmerged entry
+_STATUS_CODES = ".MTADRCU"
+_UNMERGED_CODES = ["DD", "AU", "UD", "UA", "DU", "AA", "UU"]
+
+
+# The output of "git status --porcelain=v2 --branch -z". Records are parsed as
+# they're read from the pipe, so the output is never held in memory as a
+# whole. Untracked and ignored paths are kept as plain strings and the rest
+# as GitStatusEntry objects, each in every list it belongs to:
+# - staged: entries with changes in the index (X isn't ".")
+# - unstaged: entries with changes in the work tree (Y isn't ".")
+# - unmerged: entries with merge conflicts, which are in neither of the above
 class GitStatus:
     def __init__(self) -> None:
-        self.staged_modified: list[str] = []
-        self.staged_added: list[str] = []
-        self.unstaged_modified: list[str] = []
+        self.branch = GitBranchStatus()
+        self.staged: list[GitStatusEntry] = []
+        self.unstaged: list[GitStatusEntry] = []
+        self.unmerged: list[GitStatusEntry] = []
         self.untracked: list[str] = []
+        self.ignored: list[str] = []
 
     def is_add_required(self) -> bool:
-        return (len(self.unstaged_modified) + len(self.untracked)) > 0
+        return (len(self.unstaged) + len(self.untracked)) > 0
 
     def is_commit_required(self) -> bool:
-        return (
-            self.is_add_required()
-            or (len(self.staged_modified) + len(self.staged_added)) > 0
-        )
+        return self.is_add_required() or len(self.staged) > 0
+
+    def has_conflicts(self) -> bool:
+        return len(self.unmerged) > 0
 
     @staticmethod
-    def parse(lines: list[str]) -> "GitStatus":
+    def parse(stream: IO[bytes]) -> "GitStatus":
         status = GitStatus()
-        for line in lines:
-            status._parse_line(line)
+        records = GitStatus._read_records(stream)
+        for record in records:
+            status._parse_record(record, records)
         return status
 
-    def _parse_line(self, line: str) -> None:
-        file_status = line[:2]
-        file_path = line[2:]
-
-        if len(file_status) != 2 or file_status == "  ":
-            raise Exception(f"Invalid file status: {file_status}")
-
-        if file_status == "??":
-            self.untracked.append(file_path)
-            return
-
-        staged_status = file_status[0]
-        if staged_status == " ":
-            pass
-        elif staged_status == "M":
-            self.staged_modified.append(file_path)
-        elif staged_status == "A":
-            self.staged_added.append(file_path)
+    # Yields the NUL terminated records as the chunks they span are read
+    @staticmethod
+    def _read_records(stream: IO[bytes]) -> Iterator[bytes]:
+        pending = b""
+        while True:
+            chunk = stream.read(64 * 1024)
+            if chunk == b"":
+                break
+            records = (pending + chunk).split(b"\0")
+            pending = records.pop()
+            yield from records
+        if pending != b"":
+            raise Exception("Truncated git status output")
+
+    # The records are:
+    #     # <header> <value>
+    #     1 <XY> <sub> <mH> <mI> <mW> <hH> <hI> <path>
+    #     2 <XY> <sub> <mH> <mI> <mW> <hH> <hI> <X><score> <path>\0<origPath>
+    #     u <XY> <sub> <m1> <m2> <m3> <mW> <h1> <h2> <h3> <path>
+    #     ? <path>
+    #     ! <path>
+    def _parse_record(self, record: bytes, records: Iterator[bytes]) -> None:
+        kind = record[:2]
+        if kind == b"? ":
+            self.untracked.append(os.fsdecode(record[2:]))
+        elif kind == b"! ":
+            self.ignored.append(os.fsdecode(record[2:]))
+        elif kind == b"# ":
+            self.branch._parse_header(record.decode("utf-8", "replace"))
+        elif kind == b"1 ":
+            fields = record.split(b" ", 8)
+            self._add_entry(GitStatus._entry(record, fields, 9))
+        elif kind == b"2 ":
+            fields = record.split(b" ", 9)
+            entry = GitStatus._entry(record, fields, 10)
+            orig_path = next(records, None)
+            if orig_path is None:
+                raise Exception("Truncated git status output")
+            entry.orig_path = os.fsdecode(orig_path)
+            self._add_entry(entry)
+        elif kind == b"u ":
+            fields = record.split(b" ", 10)
+            entry = GitStatus._entry(record, fields, 11)
+            if entry.xy not in _UNMERGED_CODES:
+                raise Exception(f"Invalid file status: {entry.xy}")
+            self.unmerged.append(entry)
         else:
-            raise Exception(f"Unknown file status: {file_status}")
+            raise Exception(f"Unknown git status record: {record!r}")
 
-        unstaged_status = file_status[1]
-        if unstaged_status == " ":
-            pass
-        elif unstaged_status == "M":
-            self.unstaged_modified.append(file_path)
-        else:
-            raise Exception(f"Unknown file status: {file_status}")
+    @staticmethod
+    def _entry(record: bytes, fields: list[bytes], count: int) -> GitStatusEntry:
+        if len(fields) != count:
+            raise Exception(f"Invalid git status record: {record!r}")
+        xy = fields[1].decode("ascii", "replace")
+        if len(xy) != 2 or any(c not in _STATUS_CODES for c in xy):
+            raise Exception(f"Invalid file status: {xy}")
+        return GitStatusEntry(xy, os.fsdecode(fields[-1]))
+
+    def _add_entry(self, entry: GitStatusEntry) -> None:
+        if entry.xy == "..":
+            raise Exception(f"Invalid file status: {entry.xy}")
+        if entry.xy[0] != ".":
+            self.staged.append(entry)
+        if entry.xy[1] != ".":
+            self.unstaged.append(entry)
 
     def to_dict(self):
         return {
-            "staged_modified": self.staged_modified,
-            "staged_added": self.staged_added,
-            "unstaged_modified": self.unstaged_modified,
+            "staged": [e.to_dict() for e in self.staged],
+            "unstaged": [e.to_dict() for e in self.unstaged],
+            "unmerged": [e.to_dict() for e in self.unmerged],
             "untracked": self.untracked,
+            "ignored": self.ignored,
+            "branch": self.branch.to_dict(),
         }
 
     def to_json(self):
@@ -197,7 +322,9 @@ class Git:
         raise Exception("Failed to identify current branch")
 
     @staticmethod
-    def get_commits(remote: str = None, limit: int = None) -> list[GitCommit]:
+    def get_commits(
+        remote: Optional[str] = None, limit: Optional[int] = None
+    ) -> list[GitCommit]:
         fmt_hash = "%H"
         fmt_message = "%s"
 
@@ -224,9 +351,70 @@ class Git:
         subprocess.check_call(["git", "fetch", "--all"])
 
     @staticmethod
-    def status() -> GitStatus:
-        lines = _execute_git_command(["git", "status", "--short"], strip=False)
-        return GitStatus.parse(lines)
+    def is_repository(directory: str) -> bool:
+        cmd = ["git", "rev-parse", "--is-inside-work-tree"]
+        p = subprocess.run(
+            cmd, cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        return p.returncode == 0
+
+    # Lists the files under the directory that are tracked, or untracked but
+    # not ignored, relative to it. Ignored directories are never walked.
+    @staticmethod
+    def list_files(directory: str) -> list[str]:
+        cmd = ["git", "ls-files", "-z", "--cached", "--others", "--exclude-standard"]
+        files = _execute_git_command(cmd, strip=False, cwd=directory, separator="\0")
+        # Tracked files that were deleted from the working tree are still listed
+        return [f for f in files if os.path.isfile(os.path.join(directory, f))]
+
+    # Lists the files under the directory that differ from the given commit,
+    # whether the changes were committed since, staged or not, along with
+    # untracked files that aren't ignored. Deleted files are left out. Paths
+    # are relative to the directory.
+    @staticmethod
+    def get_changed_files(directory: str, since: str = "HEAD") -> list[str]:
+        Log.debug("getting changed files", {"directory": directory, "since": since})
+        diff_cmd = [
+            "git",
+            "diff",
+            "-z",
+            "--name-only",
+            "--relative",
+            "--diff-filter=d",
+            since,
+            "--",
+        ]
+        others_cmd = ["git", "ls-files", "-z", "--others", "--exclude-standard"]
+        files: list[str] = []
+        for cmd in [diff_cmd, others_cmd]:
+            files += _execute_git_command(
+                cmd, strip=False, cwd=directory, separator="\0"
+            )
+        return sorted(set(files))
+
+    @staticmethod
+    def status(directory: Optional[str] = None) -> GitStatus:
+        cmd = ["git", "status", "--porcelain=v2", "--branch", "-z"]
+        # stderr goes to a file rather than a pipe so that it can't fill up and
+        # block git while stdout is being read
+        with tempfile.TemporaryFile() as stderr:
+            with subprocess.Popen(
+                cmd, stdout=subprocess.PIPE, stderr=stderr, cwd=directory
+            ) as p:
+                if p.stdout is None:
+                    raise Exception("Git command failed: {}".format(" ".join(cmd)))
+                try:
+                    status = GitStatus.parse(p.stdout)
+                except Exception:
+                    p.kill()
+                    raise
+            if p.returncode != 0:
+                stderr.seek(0)
+                error = stderr.read().decode("utf-8", "replace").strip()
+                raise Exception(
+                    "Git command failed: {}: {}".format(" ".join(cmd), error)
+                )
+        return status
 
     @staticmethod
     def add_all() -> None:
@@ -267,3 +455,174 @@ class Git:
     def cherry_pick(hash: str) -> None:
         Log.debug("cherry-picking commit", {"hash": hash})
         subprocess.check_call(["git", "cherry-pick", hash])
+
+
+# A long-lived "git cat-file" process that objects are looked up through one
+# at a time, rather than starting a git process per lookup
+class _CatFile:
+    def __init__(self, option: str) -> None:
+        self._option = option
+        self._process = subprocess.Popen(
+            ["git", "cat-file", option],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        if self._process.stdin is None or self._process.stdout is None:
+            raise Exception("Failed to start git cat-file")
+        self._stdin = self._process.stdin
+        self._stdout = self._process.stdout
+
+    # Returns the object's header fields (name, type and size) and, with
+    # --batch, its contents. Returns None if the object doesn't exist.
+    def request(self, rev: str) -> Optional[tuple[list[str], bytes]]:
+        if "\n" in rev:
+            raise Exception(f"Invalid git revision: {rev!r}")
+        self._stdin.write(rev.encode("utf-8") + b"\n")
+        self._stdin.flush()
+
+        header = self._stdout.readline()
+        if header == b"":
+            raise Exception(f"git cat-file {self._option} exited unexpectedly")
+        fields = header.decode("utf-8").split()
+        if fields[-1] in ["missing", "ambiguous"]:
+            return None
+
+        contents = b""
+        if self._option == "--batch":
+            # The contents are followed by a newline
+            contents = self._stdout.read(int(fields[2]) + 1)[:-1]
+        return fields, contents
+
+    def close(self) -> None:
+        self._stdin.close()
+        self._process.wait()
+
+
+# Runs the git commands of a single command invocation against the repository
+# in the current directory. Reads are memoized until the session itself does
+# something that changes the repository, so the same question never costs two
+# git processes:
+# - status() and branch() share one "git status --porcelain=v2 --branch" run,
+#   which reports HEAD, its upstream and the ahead/behind counts along with
+#   the file statuses
+# - resolve() and get_commit() go through long-lived "git cat-file" processes
+#
+# Changes made outside the session aren't seen until invalidate() is called.
+# Use it as a context manager so the cat-file processes are closed.
+class GitSession:
+    def __init__(self) -> None:
+        self._status: Optional[GitStatus] = None
+        self._hashes: dict[str, Optional[str]] = {}
+        self._commits: dict[str, Optional[GitCommit]] = {}
+        self._merge_bases: dict[tuple[str, str], Optional[str]] = {}
+        self._counts: dict[tuple[str, str], tuple[int, int]] = {}
+        self._batch_check: Optional[_CatFile] = None
+        self._batch: Optional[_CatFile] = None
+
+    def __enter__(self) -> "GitSession":
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.close()
+
+    def close(self) -> None:
+        for cat_file in [self._batch_check, self._batch]:
+            if cat_file is not None:
+                cat_file.close()
+        self._batch_check = None
+        self._batch = None
+
+    # Forgets everything memoized. The cat-file processes are restarted too,
+    # as they may not pick up new objects or refs.
+    def invalidate(self) -> None:
+        self._status = None
+        self._hashes.clear()
+        self._commits.clear()
+        self._merge_bases.clear()
+        self._counts.clear()
+        self.close()
+
+    def status(self) -> GitStatus:
+        if self._status is None:
+            self._status = Git.status()
+        return self._status
+
+    def branch(self) -> GitBranchStatus:
+        return self.status().branch
+
+    # Returns the hash of the object the revision names, or None if it
+    # doesn't name one
+    def resolve(self, rev: str) -> Optional[str]:
+        if rev not in self._hashes:
+            if self._batch_check is None:
+                self._batch_check = _CatFile("--batch-check")
+            result = self._batch_check.request(rev)
+            self._hashes[rev] = None if result is None else result[0][0]
+        return self._hashes[rev]
+
+    def get_commit(self, rev: str) -> Optional[GitCommit]:
+        if rev not in self._commits:
+            if self._batch is None:
+                self._batch = _CatFile("--batch")
+            result = self._batch.request(f"{rev}^{{commit}}")
+            commit = None
+            if result is not None:
+                fields, contents = result
+                # The message follows the headers after a blank line
+                message = contents.decode("utf-8", "replace").partition("\n\n")[2]
+                commit = GitCommit(fields[0], message.split("\n", 1)[0])
+            self._commits[rev] = commit
+        return self._commits[rev]
+
+    # Returns the best common ancestor of the two commits, or None if their
+    # histories are unrelated
+    def merge_base(self, a: str, b: str) -> Optional[str]:
+        if (a, b) not in self._merge_bases:
+            cmd = ["git", "merge-base", a, b]
+            p = subprocess.run(cmd, stdout=subprocess.PIPE, text=True)
+            # merge-base exits with 1 if there's no common ancestor
+            if p.returncode not in [0, 1]:
+                raise Exception("Git command failed: {}".format(" ".join(cmd)))
+            self._merge_bases[(a, b)] = p.stdout.strip() or None
+        return self._merge_bases[(a, b)]
+
+    # Returns how many commits each side has that the other doesn't, walking
+    # only the commits since they diverged
+    def count_ahead_behind(self, local: str, remote: str) -> tuple[int, int]:
+        if (local, remote) not in self._counts:
+            cmd = ["git", "rev-list", "--left-right", "--count", f"{local}...{remote}"]
+            ahead, behind = _execute_git_command(cmd)[0].split()
+            self._counts[(local, remote)] = (int(ahead), int(behind))
+        return self._counts[(local, remote)]
+
+    def fetch_all(self) -> None:
+        Git.fetch_all()
+        self.invalidate()
+
+    def add_all(self) -> None:
+        Git.add_all()
+        self.invalidate()
+
+    def commit(self, message: str) -> None:
+        Git.commit(message)
+        self.invalidate()
+
+    def push(self, remote: str, branch: str) -> None:
+        Git.push(remote, branch)
+        self.invalidate()
+
+    def pull(self, remote: str, branch: str, rebase: bool = False) -> None:
+        Git.pull(remote, branch, rebase)
+        self.invalidate()
+
+    def create_branch(self, name: str) -> None:
+        Git.create_branch(name)
+        self.invalidate()
+
+    def checkout(self, target: str) -> None:
+        Git.checkout(target)
+        self.invalidate()
+
+    def cherry_pick(self, hash: str) -> None:
+        Git.cherry_pick(hash)
+        self.invalidate()
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+
+import os
+import re
+from typing import Optional
+
+# Ignore files are made up of one pattern per line. Blank lines and lines
+# starting with '#' are ignored. Patterns are regular expressions by default
+# (matched with re.match against the path relative to the ignore file's
+# directory) but a "syntax: glob" line switches the patterns that follow it to
+# gitignore-style globs and "syntax: regexp" switches back:
+#
+#     # Regular expressions match files, or directories with a "d " prefix
+#     ^.*\.pyc$
+#     d ^build$
+#
+#     syntax: glob
+#     node_modules/
+#     *.log
+#     /dist
+#     !keep.log
+#
+# A glob matches both files and directories unless it has a trailing '/', in
+# which case it only matches directories. A leading '!' re-includes
+# paths excluded by an earlier pattern and a glob without a '/' (other than a
+# trailing one) matches at any depth. As in gitignore, the last matching
+# pattern wins.
+
+_SYNTAX_REGEXP = "regexp"
+_SYNTAX_GLOB = "glob"
+
+# Matches the constructs that stop a pattern from being joined with others:
+# "(?" other than a non-capturing group (inline flags, named groups and
+# references, lookarounds) and numbered backreferences
+_UNJOINABLE = re.compile(r"\(\?(?!:)|\\[1-9]")
+
+
+class IgnoreRule:
+    def __init__(
+        self, regex: str, negate: bool, files: bool, dirs: bool, basename: bool
+    ) -> None:
+        self.regex = regex
+        self.negate = negate
+        self.files = files
+        self.dirs = dirs
+        # Whether the regex is matched against only the last path component
+        # rather than the whole relative path
+        self.basename = basename
+
+
+class _RuleGroup:
+    def __init__(self, rules: list[IgnoreRule]) -> None:
+        self.negate = rules[0].negate
+        self.path_regexes = _RuleGroup._join([r for r in rules if not r.basename])
+        self.basename_regexes = _RuleGroup._join([r for r in rules if r.basename])
+
+    def match(self, path_rel: str) -> bool:
+        for regex in self.path_regexes:
+            if regex.match(path_rel):
+                return True
+        if len(self.basename_regexes) > 0:
+            basename = path_rel[path_rel.rfind("/") + 1 :]
+            for regex in self.basename_regexes:
+                if regex.match(basename):
+                    return True
+        return False
+
+    # Joins the rules into one alternation, except for those that would mean
+    # something else inside one: global inline flags are only allowed at the
+    # very start of a pattern, and group names and backreference numbers would
+    # clash with the other alternatives' groups. Those are compiled on their
+    # own.
+    @staticmethod
+    def _join(rules: list[IgnoreRule]) -> list[re.Pattern]:
+        simple = []
+        regexes = []
+        for rule in rules:
+            if _UNJOINABLE.search(rule.regex) is None:
+                simple.append(rule.regex)
+            else:
+                regexes.append(re.compile(rule.regex))
+        if len(simple) > 0:
+            regexes.insert(0, re.compile("|".join([f"(?:{r})" for r in simple])))
+        return regexes
+
+
+# The patterns from a single ignore file, compiled into as few regular
+# expressions as possible. Consecutive patterns with the same polarity are
+# joined into one alternation (or two, as patterns that only look at the file
+# name are matched separately against it), so a file without negations costs
+# at most two regex matches per path no matter how many patterns it has.
+class IgnoreRules:
+    def __init__(self, rules: list[IgnoreRule]) -> None:
+        self._file_groups = IgnoreRules._compile([r for r in rules if r.files])
+        self._dir_groups = IgnoreRules._compile([r for r in rules if r.dirs])
+
+    @staticmethod
+    def parse(content: str) -> "IgnoreRules":
+        rules = []
+        syntax = _SYNTAX_REGEXP
+        for line in content.split("\n"):
+            line = line.strip()
+            if line == "" or line.startswith("#"):
+                continue
+            if line.lower().startswith("syntax:"):
+                syntax = IgnoreRules._parse_syntax(line)
+                continue
+            if syntax == _SYNTAX_GLOB:
+                rules.append(IgnoreRules._parse_glob(line))
+            else:
+                rules.append(IgnoreRules._parse_regexp(line))
+        return IgnoreRules(rules)
+
+    # Returns None if the ignore file doesn't exist
+    @staticmethod
+    def load(path: str) -> Optional["IgnoreRules"]:
+        try:
+            with open(path, "r") as f:
+                return IgnoreRules.parse(f.read())
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+    # Returns True if the path is ignored, False if it was explicitly
+    # re-included by a negated pattern and None if no pattern matched
+    def match(self, path_rel: str, is_dir: bool) -> Optional[bool]:
+        groups = self._dir_groups if is_dir else self._file_groups
+        for group in reversed(groups):
+            if group.match(path_rel):
+                return not group.negate
+        return None
+
+    @staticmethod
+    def _compile(rules: list[IgnoreRule]) -> list[_RuleGroup]:
+        groups = []
+        i = 0
+        while i < len(rules):
+            j = i
+            while j < len(rules) and rules[j].negate == rules[i].negate:
+                j += 1
+            groups.append(_RuleGroup(rules[i:j]))
+            i = j
+        return groups
+
+    @staticmethod
+    def _parse_syntax(line: str) -> str:
+        syntax = line.split(":", 1)[1].strip().lower()
+        if syntax not in [_SYNTAX_REGEXP, _SYNTAX_GLOB]:
+            raise Exception(f"Unknown ignore file syntax '{syntax}'")
+        return syntax
+
+    @staticmethod
+    def _parse_regexp(line: str) -> IgnoreRule:
+        is_dir_pattern = line.lower().startswith("d ")
+        if is_dir_pattern:
+            line = line[2:]
+        try:
+            re.compile(line)
+        except re.error as e:
+            raise Exception(f"Invalid ignore pattern '{line}'") from e
+        return IgnoreRule(
+            line,
+            negate=False,
+            files=not is_dir_pattern,
+            dirs=is_dir_pattern,
+            basename=False,
+        )
+
+    @staticmethod
+    def _parse_glob(line: str) -> IgnoreRule:
+        negate = line.startswith("!")
+        if negate:
+            line = line[1:]
+
+        dir_only = line.endswith("/")
+        line = line.rstrip("/")
+
+        # Like gitignore, a pattern containing a slash is relative to the
+        # ignore file's directory, otherwise it matches the name at any depth
+        basename = "/" not in line
+        line = line.lstrip("/")
+
+        regex = glob_to_regex(line) + r"\Z"
+        return IgnoreRule(
+            regex, negate, files=not dir_only, dirs=True, basename=basename
+        )
+
+
+# Stack of ignore rules loaded from nested ignore files, each layered on top of
+# the ones from its parent directories. Rules are pushed as directories are
+# entered; because walks are depth-first, layers that no longer apply are
+# popped lazily as soon as the walk moves outside their directory.
+class IgnoreStack:
+    def __init__(self) -> None:
+        self._layers: list[tuple[str, IgnoreRules]] = []
+
+    # Adds the rules from an ignore file in the directory with the given
+    # relative path ("" for the root directory)
+    def push(self, dir_rel: str, rules: IgnoreRules) -> None:
+        prefix = dir_rel + "/" if dir_rel != "" else ""
+        self._pop_until(prefix)
+        self._layers.append((prefix, rules))
+
+    def push_file(self, dir_rel: str, dir_abs: str, file_name: str) -> None:
+        rules = IgnoreRules.load(os.path.join(dir_abs, file_name))
+        if rules is not None:
+            self.push(dir_rel, rules)
+
+    def is_ignored(self, path_rel: str, is_dir: bool) -> bool:
+        self._pop_until(path_rel)
+
+        for prefix, rules in reversed(self._layers):
+            result = rules.match(path_rel[len(prefix) :], is_dir)
+            if result is not None:
+                return result
+        return False
+
+    # Pops the layers for directories that don't contain the given path
+    def _pop_until(self, path_rel: str) -> None:
+        while len(self._layers) > 0 and not path_rel.startswith(self._layers[-1][0]):
+            self._layers.pop()
+
+
+# Translates a gitignore-style glob to a regular expression. '*' and '?' don't
+# match '/', '**' matches across directories.
+def glob_to_regex(glob: str) -> str:
+    regex = ""
+    i = 0
+    while i < len(glob):
+        c = glob[i]
+        if glob.startswith("**/", i):
+            regex += "(?:.*/)?"
+            i += 3
+            continue
+        if glob.startswith("**", i):
+            regex += ".*"
+            i += 2
+            continue
+        if c == "*":
+            regex += "[^/]*"
+        elif c == "?":
+            regex += "[^/]"
+        elif c == "[":
+            end = glob.find("]", i + 2)
+            if end == -1:
+                regex += re.escape(c)
+            else:
+                char_class = glob[i + 1 : end]
+                if char_class.startswith("!"):
+                    char_class = "^" + char_class[1:]
+                regex += f"[{char_class}]"
+                i = end
+        else:
+            regex += re.escape(c)
+        i += 1
+    return regex
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+import ctypes
+import errno
+import os
+import struct
+from typing import Optional
+
+# Minimal wrapper around the Linux inotify API, called through libc with ctypes
+# so that it doesn't need any third party packages. The file descriptor is
+# non-blocking; use fileno() with select/selectors to wait for events.
+
+
+class InotifyEvent:
+    __slots__ = ("wd", "mask", "name")
+
+    def __init__(self, wd: int, mask: int, name: str) -> None:
+        self.wd = wd
+        self.mask = mask
+        self.name = name
+
+    def is_dir(self) -> bool:
+        return self.mask & Inotify.IN_ISDIR != 0
+
+
+class Inotify:
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+
+    # struct inotify_event without its trailing, NUL padded name
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self) -> None:
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        fd: int = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            Inotify._raise_errno("inotify_init1")
+        self._fd = fd
+
+    def fileno(self) -> int:
+        return self._fd
+
+    # Returns the watch descriptor, or None if the path can't be watched: it no
+    # longer exists, isn't a directory (when IN_ONLYDIR is set), isn't
+    # readable or the user is out of watches (see the fs.inotify.max_user_watches
+    # sysctl)
+    def add_watch(self, path: str, mask: int) -> Optional[int]:
+        wd: int = self._libc.inotify_add_watch(self._fd, os.fsencode(path), mask)
+        if wd < 0:
+            unwatchable = [errno.ENOENT, errno.ENOTDIR, errno.ENOSPC, errno.EACCES]
+            if ctypes.get_errno() in unwatchable:
+                return None
+            Inotify._raise_errno("inotify_add_watch", path)
+        return wd
+
+    def rm_watch(self, wd: int) -> None:
+        # Fails with EINVAL if the watch was already removed by the kernel,
+        # e.g. because the directory was deleted, which is fine
+        self._libc.inotify_rm_watch(self._fd, wd)
+
+    # Returns the events that are queued without blocking
+    def read(self) -> list[InotifyEvent]:
+        events: list[InotifyEvent] = []
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                return events
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, name_len = Inotify.EVENT.unpack_from(data, offset)
+                offset += Inotify.EVENT.size
+                name = data[offset : offset + name_len].rstrip(b"\0")
+                offset += name_len
+                events.append(InotifyEvent(wd, mask, os.fsdecode(name)))
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+    @staticmethod
+    def _raise_errno(function: str, path: Optional[str] = None) -> None:
+        error = ctypes.get_errno()
+        raise OSError(error, f"{function}: {os.strerror(error)}", path)
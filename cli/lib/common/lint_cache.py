@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+
+import ast
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from typing import Optional
+
+from lib.common.log import Log
+
+# Remembers which files passed each lint check, so that unchanged files can be
+# skipped on the next run. Checks are keyed by the SHA-256 of what they depend
+# on:
+# - "tidy": the file's contents
+# - "mypy": the file's contents and those of every local module it imports,
+#   directly or not, as a change to an imported module's types can break the
+#   files that use it
+#
+# The whole cache is also tied to an environment string (the tool versions and
+# config files) and is discarded when that changes. Only passing checks are
+# stored, and only the latest key for each file, so the cache doesn't grow
+# beyond one entry per file.
+#
+# File schema:
+# {
+#   "environment": "<sha256>",
+#   "files": {
+#     "/path/to/file.py": {"tidy": "<sha256>", "mypy": "<sha256>"},
+#     ...
+#   }
+# }
+
+
+class LintCache:
+    TIDY = "tidy"
+    MYPY = "mypy"
+
+    def __init__(
+        self, path: str, environment: str, files: dict[str, dict[str, str]]
+    ) -> None:
+        self._path = path
+        self._environment = environment
+        self._files = files
+        self._lock = threading.Lock()
+        self._hashes: dict[str, Optional[bytes]] = {}
+        self._imports: dict[str, list[str]] = {}
+        self.hits = {LintCache.TIDY: 0, LintCache.MYPY: 0}
+        self.misses = {LintCache.TIDY: 0, LintCache.MYPY: 0}
+
+    @staticmethod
+    def load(path: str, environment: str) -> "LintCache":
+        files: dict[str, dict[str, str]] = {}
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+            if data.get("environment") == environment:
+                files = data["files"]
+            else:
+                Log.info("discarding lint cache", {"reason": "environment changed"})
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError, AttributeError):
+            Log.warn("discarding unreadable lint cache", {"path": path})
+        return LintCache(path, environment, files)
+
+    # Returns whether the check passed for the file as it is now, counting the
+    # lookup as a hit or a miss
+    def is_clean(self, check: str, file: str) -> bool:
+        with self._lock:
+            key = self._key(check, file)
+            entry = self._files.get(os.path.abspath(file), {})
+            clean = key is not None and entry.get(check) == key
+            (self.hits if clean else self.misses)[check] += 1
+        return clean
+
+    def set_clean(self, check: str, file: str) -> None:
+        with self._lock:
+            key = self._key(check, file)
+            if key is None:
+                return
+            self._files.setdefault(os.path.abspath(file), {})[check] = key
+
+    def set_dirty(self, check: str, file: str) -> None:
+        with self._lock:
+            self._files.get(os.path.abspath(file), {}).pop(check, None)
+
+    # Writes the cache to a temporary file that replaces the old one, so that
+    # an interrupted run never leaves a partial cache behind
+    def save(self) -> None:
+        directory = os.path.dirname(self._path)
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "w", dir=directory, prefix=".lint_cache.", delete=False
+        ) as f:
+            json.dump({"environment": self._environment, "files": self._files}, f)
+        os.replace(f.name, self._path)
+
+    # Returns None if the file can't be read, which is never cached. Must be
+    # called with the lock held, as the hashes and imports of the files it
+    # reads are memoized together.
+    def _key(self, check: str, file: str) -> Optional[str]:
+        file = os.path.abspath(file)
+        files = [file] if check == LintCache.TIDY else self._closure(file)
+        sha256 = hashlib.sha256()
+        for path in files:
+            digest = self._hash(path)
+            if digest is None:
+                return None
+            sha256.update(path.encode("utf-8") + b"\0" + digest)
+        return sha256.hexdigest()
+
+    def _hash(self, file: str) -> Optional[bytes]:
+        if file not in self._hashes:
+            try:
+                with open(file, "rb") as f:
+                    contents = f.read()
+            except OSError:
+                self._hashes[file] = None
+                return None
+            # Imports first, so a file with a hash always has its imports
+            self._imports[file] = LintCache._local_imports(file, contents)
+            self._hashes[file] = hashlib.sha256(contents).digest()
+        return self._hashes[file]
+
+    # The file and every local module it imports, directly or not, sorted
+    def _closure(self, file: str) -> list[str]:
+        seen = {file}
+        stack = [file]
+        while len(stack) > 0:
+            path = stack.pop()
+            self._hash(path)
+            for module in self._imports.get(path, []):
+                if module not in seen:
+                    seen.add(module)
+                    stack.append(module)
+        return sorted(seen)
+
+    # Returns the paths of the modules a file imports that can be found next to
+    # it, i.e. in its package root or the current directory like mypy looks.
+    # Anything else (the standard library, third party packages) is covered by
+    # the environment.
+    @staticmethod
+    def _local_imports(file: str, contents: bytes) -> list[str]:
+        try:
+            tree = ast.parse(contents, filename=file)
+        except (SyntaxError, ValueError):
+            return []
+
+        roots = [LintCache._package_root(file), os.getcwd()]
+        names: set[str] = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names.update(alias.name for alias in node.names)
+            elif isinstance(node, ast.ImportFrom):
+                base = LintCache._resolve_relative(file, node.module, node.level)
+                if base is None:
+                    continue
+                names.add(base)
+                # The imported names may be submodules rather than attributes
+                names.update(f"{base}.{alias.name}" for alias in node.names)
+
+        paths = set()
+        for name in names:
+            # Importing a.b.c also imports the packages a and a.b
+            parts = name.split(".")
+            for i in range(1, len(parts) + 1):
+                path = LintCache._find_module(roots, parts[:i])
+                if path is not None:
+                    paths.add(path)
+        paths.discard(file)
+        return sorted(paths)
+
+    @staticmethod
+    def _resolve_relative(
+        file: str, module: Optional[str], level: int
+    ) -> Optional[str]:
+        if level == 0:
+            return module
+        directory = os.path.dirname(file)
+        for _ in range(level - 1):
+            directory = os.path.dirname(directory)
+        root = LintCache._package_root(file)
+        package = os.path.relpath(directory, root).replace(os.sep, ".")
+        if package.startswith(".."):
+            return None
+        if package == ".":
+            return module
+        return package if module is None else f"{package}.{module}"
+
+    @staticmethod
+    def _find_module(roots: list[str], parts: list[str]) -> Optional[str]:
+        for root in roots:
+            base = os.path.join(root, *parts)
+            for path in [base + ".py", os.path.join(base, "__init__.py")]:
+                if os.path.isfile(path):
+                    return os.path.abspath(path)
+        return None
+
+    # The directory above the outermost package containing the file
+    @staticmethod
+    def _package_root(file: str) -> str:
+        directory = os.path.dirname(file)
+        while os.path.isfile(os.path.join(directory, "__init__.py")):
+            directory = os.path.dirname(directory)
+        return directory
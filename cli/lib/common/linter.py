@@ -1,14 +1,41 @@
 #!/usr/bin/env python
 
+import difflib
 import hashlib
+import importlib
 import os
 import re
-import shutil
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 
 from lib.common.dir import Dir
 from lib.common.file_walker import FileWalker
+from lib.common.git import Git
+from lib.common.lint_cache import LintCache
 from lib.common.log import Log
-from lib.common.util import Util, sh
+from lib.common.util import sh
+
+# File names that are linted and tidied when no files are given, as one
+# alternation so that each name costs a single match
+_PYTHON_FILE_PATTERN = re.compile(
+    "|".join(
+        f"(?:{pattern})"
+        for pattern in [
+            r"^.*\.py$",
+            r"^fzf_cached_wsl$",
+            r"^textpack$",
+        ]
+    )
+)
+
+# Matches the lines where mypy reports an error, capturing the file's path
+_MYPY_ERROR_PATTERN = re.compile(r"^(.+?):(?:\d+:)* error: ")
+
+# How long the mypy daemon stays up without being asked to check anything
+_DAEMON_IDLE_TIMEOUT = 30 * 60
 
 
 class Linter:
@@ -18,8 +45,12 @@ class Linter:
             self.msg = msg
 
         @staticmethod
-        def untidy(file):
-            return Linter.Error(file, "file is not tidy")
+        def untidy(file: str, diff: str) -> "Linter.Error":
+            return Linter.Error(file, f"file is not tidy\n{diff}")
+
+        @staticmethod
+        def unformattable(file: str, error: Exception) -> "Linter.Error":
+            return Linter.Error(file, f"file could not be tidied: {error}")
 
         @staticmethod
         def incorrect_type_hints(file):
@@ -28,17 +59,104 @@ class Linter:
         def __str__(self) -> str:
             return f"{self.file}: {self.msg}"
 
+    # The outcome of linting a single file. The tools' output is captured
+    # rather than streamed so that files linted in parallel don't interleave.
+    class Result:
+        def __init__(self) -> None:
+            self.errors: list[Linter.Error] = []
+            self.output = ""
+
+    # Total time spent in each tool across all of the files being linted
+    class Timings:
+        def __init__(self) -> None:
+            self._lock = threading.Lock()
+            self._seconds: dict[str, float] = {}
+
+        def add(self, tool: str, seconds: float) -> None:
+            with self._lock:
+                self._seconds[tool] = self._seconds.get(tool, 0.0) + seconds
+
+        def to_dict(self) -> dict[str, str]:
+            return {tool: f"{s:.2f}s" for tool, s in sorted(self._seconds.items())}
+
+    # Files are linted on a thread pool, as nearly all of the time is spent
+    # waiting on tool subprocesses. Results are reported in the order the files
+    # were given regardless of which finish first.
+    #
+    # In batch mode, each tool is instead run once over all of the files (or
+    # as few times as the command line length limit allows), which saves an
+    # interpreter startup per file per tool and lets mypy analyze the modules
+    # the files share once rather than once per file.
+    #
+    # Checks that passed on an earlier run are skipped if nothing they depend
+    # on has changed since (see LintCache).
+    #
+    # With daemon, type checking goes through a mypy daemon (dmypy) that's kept
+    # running for the dotfiles checkout, so warm runs only re-analyze what
+    # changed rather than every imported module and stub. The daemon is started
+    # on demand, exits after being idle for a while and always checks the files
+    # in one batch.
     @staticmethod
-    def lint(files: list[str]) -> None:
+    def lint(
+        files: list[str],
+        workers: int = 1,
+        batch: bool = False,
+        cache: bool = True,
+        since: Optional[str] = None,
+        daemon: bool = False,
+    ) -> None:
+        files = Linter._get_files(files, since)
         if len(files) == 0:
-            files = Linter._get_python_files()
+            Log.info("no files to lint")
+            return
 
-        Util.rmdir(Linter._tmp_dir())
-        os.makedirs(Linter._tmp_dir())
+        start = time.perf_counter()
+        timings = Linter.Timings()
+        lint_cache = None
+        if cache:
+            lint_cache = LintCache.load(
+                Linter._cache_path(), Linter._cache_environment()
+            )
 
         errors = []
-        for file in files:
-            errors += Linter._lint(file)
+        if batch or daemon:
+            errors = Linter._lint_batch(files, timings, lint_cache, daemon)
+        else:
+
+            def lint_file(file: str) -> Linter.Result:
+                return Linter._lint(file, timings, lint_cache)
+
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(lint_file, files))
+
+            for result in results:
+                if result.output != "":
+                    print(result.output, end="")
+                errors += result.errors
+
+        if lint_cache is not None:
+            lint_cache.save()
+            Log.info(
+                "lint cache",
+                {
+                    "tidy_hits": lint_cache.hits[LintCache.TIDY],
+                    "tidy_misses": lint_cache.misses[LintCache.TIDY],
+                    "mypy_hits": lint_cache.hits[LintCache.MYPY],
+                    "mypy_misses": lint_cache.misses[LintCache.MYPY],
+                },
+            )
+
+        Log.info(
+            "linted files",
+            {
+                "files": len(files),
+                "workers": 1 if batch or daemon else workers,
+                "batch": batch,
+                "daemon": daemon,
+                "elapsed": f"{time.perf_counter() - start:.2f}s",
+                **timings.to_dict(),
+            },
+        )
 
         if len(errors) == 0:
             return
@@ -49,88 +167,465 @@ class Linter:
         raise Exception("Linter errors encountered")
 
     @staticmethod
-    def tidy(files: list[str], dry_run: bool) -> None:
+    def tidy(
+        files: list[str],
+        dry_run: bool,
+        batch: bool = False,
+        since: Optional[str] = None,
+    ) -> None:
+        files = Linter._get_files(files, since)
         if len(files) == 0:
-            files = Linter._get_python_files()
+            Log.info("no files to tidy")
+            return
+
+        if batch:
+            Linter._tidy(files, dry_run)
+            return
 
         for file in files:
-            Linter._tidy(file, dry_run)
+            Linter._tidy([file], dry_run)
+
+    @staticmethod
+    def stop_daemon() -> None:
+        status_file = Linter._daemon_status_file()
+        if not os.path.exists(status_file):
+            Log.info("mypy daemon isn't running")
+            return
+        sh(["dmypy", "--status-file", status_file, "stop"])
+
+    @staticmethod
+    def _lint(
+        file: str, timings: "Linter.Timings", cache: Optional[LintCache]
+    ) -> "Linter.Result":
+        result = Linter.Result()
+        if Linter._needs_check(cache, LintCache.TIDY, file):
+            error = Linter._check_tidy(file, timings)
+            Linter._record_check(cache, LintCache.TIDY, file, error is None)
+            if error is not None:
+                result.errors.append(error)
+        if Linter._needs_check(cache, LintCache.MYPY, file):
+            typed = Linter._ensure_static_typing(file, result, timings)
+            Linter._record_check(cache, LintCache.MYPY, file, typed)
+            if not typed:
+                result.errors.append(Linter.Error.incorrect_type_hints(file))
+        return result
 
+    # Type checks all of the files with as few mypy runs as possible, returning
+    # the errors in file order. The tidy check runs in this process anyway, so
+    # there's nothing to batch there.
     @staticmethod
-    def _lint(file: str) -> list["Linter.Error"]:
+    def _lint_batch(
+        files: list[str],
+        timings: "Linter.Timings",
+        cache: Optional[LintCache],
+        daemon: bool = False,
+    ) -> list["Linter.Error"]:
+        tidy_errors = {}
+        for file in files:
+            if Linter._needs_check(cache, LintCache.TIDY, file):
+                error = Linter._check_tidy(file, timings)
+                Linter._record_check(cache, LintCache.TIDY, file, error is None)
+                if error is not None:
+                    tidy_errors[file] = error
+
+        typing_files = [
+            f for f in files if Linter._needs_check(cache, LintCache.MYPY, f)
+        ]
+        untyped: set[str] = set()
+        if len(typing_files) > 0:
+            untyped = Linter._check_static_typing(typing_files, timings, daemon)
+            for file in typing_files:
+                Linter._record_check(cache, LintCache.MYPY, file, file not in untyped)
+
         errors = []
-        if not Linter._ensure_tidy(file):
-            errors.append(Linter.Error.untidy(file))
-        if not Linter._ensure_static_typing(file):
-            errors.append(Linter.Error.incorrect_type_hints(file))
+        for file in files:
+            if file in tidy_errors:
+                errors.append(tidy_errors[file])
+            if file in untyped:
+                errors.append(Linter.Error.incorrect_type_hints(file))
         return errors
 
     @staticmethod
-    def _tidy(file: str, dry_run: bool) -> None:
-        Linter._remove_unused_imports(file, dry_run)
-        Linter._sort_imports(file, dry_run)
-        Linter._format_file(file, dry_run)
+    def _needs_check(cache: Optional[LintCache], check: str, file: str) -> bool:
+        return cache is None or not cache.is_clean(check, file)
 
     @staticmethod
-    def _get_python_files() -> list[str]:
-        python_file_patterns = [
-            "^.*\.py$",
-            "^fzf_cached_wsl$",
-            "^textpack$",
+    def _record_check(
+        cache: Optional[LintCache], check: str, file: str, passed: bool
+    ) -> None:
+        if cache is None:
+            return
+        if passed:
+            cache.set_clean(check, file)
+        else:
+            cache.set_dirty(check, file)
+
+    @staticmethod
+    def _tidy(files: list[str], dry_run: bool) -> None:
+        Linter._remove_unused_imports(files, dry_run)
+        Linter._sort_imports(files, dry_run)
+        Linter._format_files(files, dry_run)
+
+    # Returns the files to check: the ones given, the Python files that
+    # changed since the given commit or, failing both, every Python file
+    @staticmethod
+    def _get_files(files: list[str], since: Optional[str]) -> list[str]:
+        if since is None:
+            return files if len(files) > 0 else Linter._get_python_files()
+        if len(files) > 0:
+            raise Exception("Files can't be given along with changed files")
+        dot = Dir.dot()
+        return [
+            os.path.join(dot, file)
+            for file in Git.get_changed_files(dot, since)
+            if Linter._is_python_file(file)
         ]
 
-        def is_python_file(file_name: str) -> bool:
-            for pattern in python_file_patterns:
-                if re.match(pattern, file_name) is not None:
-                    return True
-            return False
+    # Asks git for the files when possible, so that ignored directories (e.g.
+    # virtual environments) aren't walked
+    @staticmethod
+    def _get_python_files() -> list[str]:
+        dot = Dir.dot()
+        if Git.is_repository(dot):
+            return [
+                os.path.join(dot, file)
+                for file in Git.list_files(dot)
+                if Linter._is_python_file(file)
+            ]
 
         python_files = []
-        for file in FileWalker.enumerate(Dir.dot()).get_files():
-            if is_python_file(file.get_name()):
+        for file in FileWalker.iter(dot, directories=False):
+            if _PYTHON_FILE_PATTERN.match(file.get_name()) is not None:
                 python_files.append(file.get_absolute_path())
         return python_files
 
     @staticmethod
-    def _remove_unused_imports(file: str, dry_run: bool) -> None:
-        Log.info("removing unused imports", {"file": file})
+    def _is_python_file(path: str) -> bool:
+        return _PYTHON_FILE_PATTERN.match(os.path.basename(path)) is not None
+
+    @staticmethod
+    def _remove_unused_imports(files: list[str], dry_run: bool) -> None:
+        Log.info("removing unused imports", Linter._describe(files))
         if not dry_run:
-            sh(
-                ["autoflake", "--in-place", "--remove-all-unused-imports", file],
-                check=True,
+            Linter._run_chunked(
+                ["autoflake", "--in-place", "--remove-all-unused-imports"], files
             )
 
     @staticmethod
-    def _sort_imports(file: str, dry_run: bool) -> None:
-        Log.info("sorting imports", {"file": file})
+    def _sort_imports(files: list[str], dry_run: bool) -> None:
+        Log.info("sorting imports", Linter._describe(files))
         if not dry_run:
-            sh(["isort", file], check=True)
+            Linter._run_chunked(["isort"], files)
 
     @staticmethod
-    def _format_file(file: str, dry_run: bool) -> None:
-        Log.info("formatting file", {"file": file})
+    def _format_files(files: list[str], dry_run: bool) -> None:
+        Log.info("formatting files", Linter._describe(files))
         if not dry_run:
-            sh(["black", file], check=True)
+            Linter._run_chunked(["black"], files)
 
+    # Tidies the file's source in memory and compares the result with the
+    # original, returning an error with a diff of the changes tidying would
+    # make, or None if there are none
     @staticmethod
-    def _ensure_tidy(file: str) -> bool:
-        dst = os.path.join(Linter._tmp_dir(), os.path.basename(file))
-        shutil.copyfile(file, dst)
-        Linter.tidy([dst], False)
-        return Linter._file_md5(file) == Linter._file_md5(dst)
+    def _check_tidy(file: str, timings: "Linter.Timings") -> Optional["Linter.Error"]:
+        try:
+            with open(file, "r", encoding="utf-8") as f:
+                source = f.read()
+            tidied = Linter._tidy_source(file, source, timings)
+        except Exception as e:
+            return Linter.Error.unformattable(file, e)
+        if tidied == source:
+            return None
+        diff = difflib.unified_diff(
+            source.splitlines(keepends=True),
+            tidied.splitlines(keepends=True),
+            fromfile=file,
+            tofile=f"{file} (tidied)",
+        )
+        return Linter.Error.untidy(file, "".join(diff))
 
+    # Runs the source through the same tools as tidy, using their Python APIs
+    # when they can be imported and their command lines through stdin and
+    # stdout otherwise, so that nothing is written to disk either way
     @staticmethod
-    def _ensure_static_typing(file: str) -> bool:
-        mypy_cmd = ["mypy", "--config-file", os.path.join(Dir.dot(), "mypy.ini"), file]
-        return sh(mypy_cmd) == 0
+    def _tidy_source(file: str, source: str, timings: "Linter.Timings") -> str:
+        start = time.perf_counter()
+        try:
+            import autoflake  # type: ignore
 
+            source = autoflake.fix_code(source, remove_all_unused_imports=True)
+        except ImportError:
+            source = Linter._pipe(
+                ["autoflake", "--remove-all-unused-imports", "-"], source
+            )
+        timings.add("autoflake", time.perf_counter() - start)
+
+        start = time.perf_counter()
+        try:
+            import isort
+
+            # Settings are looked up from the file's directory, as when tidying
+            # the file itself
+            config = isort.Config(settings_path=os.path.dirname(file))
+            source = isort.code(source, config=config)
+        except ImportError:
+            source = Linter._pipe(
+                ["isort", "--settings-path", os.path.dirname(file), "-"], source
+            )
+        timings.add("isort", time.perf_counter() - start)
+
+        start = time.perf_counter()
+        try:
+            import black
+
+            try:
+                source = black.format_str(source, mode=black.Mode())
+            except black.NothingChanged:
+                pass
+        except ImportError:
+            source = Linter._pipe(["black", "--quiet", "-"], source)
+        timings.add("black", time.perf_counter() - start)
+        return source
+
+    @staticmethod
+    def _pipe(cmd: list[str], source: str) -> str:
+        Log.debug(f"Executing shell command: {' '.join(cmd)}")
+        process = subprocess.run(
+            cmd, input=source, stdout=subprocess.PIPE, text=True, check=True
+        )
+        return process.stdout
+
+    @staticmethod
+    def _ensure_static_typing(
+        file: str, result: "Linter.Result", timings: "Linter.Timings"
+    ) -> bool:
+        return Linter._run(Linter._mypy_cmd() + [file], result, timings) == 0
+
+    # Type checks the files with one mypy run per group of distinct module
+    # names, returning the files that have errors. Errors that mypy reports in
+    # modules the files import, but that aren't being linted themselves, are
+    # left out.
+    #
+    # The daemon crashes when a module it has checked is replaced by another
+    # file with the same name, so it's only given the first group minus the
+    # scripts, which are all named __main__. Everything else gets a cold mypy
+    # run, as does everything if the daemon fails.
+    @staticmethod
+    def _check_static_typing(
+        files: list[str], timings: "Linter.Timings", daemon: bool = False
+    ) -> set[str]:
+        untyped: set[str] = set()
+        if daemon:
+            daemon_files = [
+                f
+                for f in Linter._group_by_module_name(files)[0]
+                if Linter._module_name(f) != "__main__"
+            ]
+            if len(daemon_files) > 0:
+                daemon_untyped = Linter._run_mypy(
+                    Linter._dmypy_cmd(), daemon_files, timings, cwd=Dir.dot()
+                )
+                if daemon_untyped is None:
+                    Log.warn("mypy daemon failed, checking without it")
+                else:
+                    untyped = daemon_untyped
+                    checked = set(daemon_files)
+                    files = [f for f in files if f not in checked]
+
+        for group in Linter._group_by_module_name(files):
+            group_untyped = Linter._run_mypy(Linter._mypy_cmd(), group, timings)
+            if group_untyped is None:
+                raise Exception("mypy failed")
+            untyped |= group_untyped
+        return untyped
+
+    # Runs mypy over the files, returning the ones with errors or None if mypy
+    # couldn't check them at all. Reported paths are relative to cwd.
+    @staticmethod
+    def _run_mypy(
+        cmd: list[str],
+        files: list[str],
+        timings: "Linter.Timings",
+        cwd: Optional[str] = None,
+    ) -> Optional[set[str]]:
+        by_path = {os.path.abspath(file): file for file in files}
+        untyped = set()
+        for chunk in Linter._chunk_args(cmd, files):
+            result = Linter.Result()
+            returncode = Linter._run(cmd + chunk, result, timings, cwd)
+            print(result.output, end="")
+            # mypy exits with 1 if it found errors and 2 if it couldn't check
+            # the files at all
+            if returncode not in [0, 1]:
+                Log.warn(f"{cmd[0]} failed", {"exit_code": returncode})
+                return None
+            for line in result.output.splitlines():
+                match = _MYPY_ERROR_PATTERN.match(line)
+                if match is None:
+                    continue
+                path = os.path.join(cwd or os.getcwd(), match.group(1))
+                file = by_path.get(os.path.abspath(path))
+                if file is not None:
+                    untyped.add(file)
+        return untyped
+
+    @staticmethod
+    def _mypy_cmd() -> list[str]:
+        return ["mypy", "--config-file", os.path.join(Dir.dot(), "mypy.ini")]
+
+    # Checks files with the daemon for this checkout, starting it if it isn't
+    # running (or restarting it if the mypy flags changed)
+    @staticmethod
+    def _dmypy_cmd() -> list[str]:
+        status_file = Linter._daemon_status_file()
+        os.makedirs(os.path.dirname(status_file), exist_ok=True)
+        return [
+            "dmypy",
+            "--status-file",
+            status_file,
+            "run",
+            "--timeout",
+            str(_DAEMON_IDLE_TIMEOUT),
+            "--log-file",
+            status_file[: -len(".json")] + ".log",
+            "--",
+        ] + Linter._mypy_cmd()[1:]
+
+    # Each dotfiles checkout gets its own daemon, as it's tied to the
+    # directory it was started in
+    @staticmethod
+    def _daemon_status_file() -> str:
+        checkout = hashlib.sha256(Dir.dot().encode("utf-8")).hexdigest()[:16]
+        return os.path.join(Dir.tmp(), "dmypy", f"{checkout}.json")
+
+    # mypy refuses to check two files with the same module name in one run
+    # (e.g. bin/textpack and cli/bench/textpack.py), so files are split into
+    # groups where each module name appears at most once
+    @staticmethod
+    def _group_by_module_name(files: list[str]) -> list[list[str]]:
+        groups: list[tuple[set[str], list[str]]] = []
+        for file in files:
+            name = Linter._module_name(file)
+            group = next((g for g in groups if name not in g[0]), None)
+            if group is None:
+                group = (set(), [])
+                groups.append(group)
+            group[0].add(name)
+            group[1].append(file)
+        return [group for _, group in groups]
+
+    # The module name mypy gives a file: its name without the extension,
+    # qualified by the packages (directories with an __init__.py) it's in.
+    # Scripts without a .py extension are all named __main__.
+    @staticmethod
+    def _module_name(file: str) -> str:
+        directory, name = os.path.split(os.path.abspath(file))
+        if not name.endswith(".py"):
+            return "__main__"
+        parts = [name[: -len(".py")]]
+        if parts[0] == "__init__":
+            parts = []
+        while os.path.isfile(os.path.join(directory, "__init__.py")):
+            directory, package = os.path.split(directory)
+            parts.insert(0, package)
+        return ".".join(parts)
+
+    # Runs a tool over the files with as few invocations as the command line
+    # length limit allows, raising if any of them fail
     @staticmethod
-    def _tmp_dir() -> str:
-        return os.path.join(Dir.tmp(), "linter")
+    def _run_chunked(cmd: list[str], files: list[str]) -> None:
+        for chunk in Linter._chunk_args(cmd, files):
+            sh(cmd + chunk, check=True)
 
+    # Splits the files into chunks that fit on a command line after cmd. The
+    # arguments share ARG_MAX with the environment, so only half of what's
+    # left after the environment is used to stay well clear of it.
     @staticmethod
-    def _file_md5(file: str) -> str:
-        md5 = hashlib.md5()
-        with open(file, "rb") as f:
-            md5.update(f.read())
-        return md5.hexdigest()
+    def _chunk_args(cmd: list[str], files: list[str]) -> list[list[str]]:
+        environ_size = sum(len(k) + len(v) + 2 for k, v in os.environ.items())
+        limit = (os.sysconf("SC_ARG_MAX") - environ_size) // 2
+        cmd_size = sum(len(arg) + 1 for arg in cmd)
+
+        chunks: list[list[str]] = []
+        size = cmd_size
+        for file in files:
+            file_size = len(os.fsencode(file)) + 1
+            if len(chunks) == 0 or size + file_size > limit:
+                chunks.append([])
+                size = cmd_size
+            chunks[-1].append(file)
+            size += file_size
+        return chunks
+
+    @staticmethod
+    def _describe(files: list[str]) -> dict[str, object]:
+        if len(files) == 1:
+            return {"file": files[0]}
+        return {"files": len(files)}
+
+    # Runs a tool, capturing its output into the result and adding the time it
+    # took to the timings
+    @staticmethod
+    def _run(
+        cmd: list[str],
+        result: "Linter.Result",
+        timings: "Linter.Timings",
+        cwd: Optional[str] = None,
+    ) -> int:
+        start = time.perf_counter()
+        Log.debug(f"Executing shell command: {' '.join(cmd)}")
+        process = subprocess.run(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, cwd=cwd
+        )
+        result.output += process.stdout
+        timings.add(cmd[0], time.perf_counter() - start)
+        return process.returncode
+
+    @staticmethod
+    def _cache_path() -> str:
+        return os.path.join(Dir.data(), "lint_cache.json")
+
+    # Identifies everything outside of the files themselves that lint results
+    # depend on: the versions of the tools, their config files and the linter
+    # itself (for the flags it passes to them)
+    @staticmethod
+    def _cache_environment() -> str:
+        tools = ["autoflake", "isort", "black", "mypy"]
+        with ThreadPoolExecutor(max_workers=len(tools)) as executor:
+            versions = list(executor.map(Linter._tool_version, tools))
+
+        sha256 = hashlib.sha256()
+        for version in versions:
+            sha256.update(version.encode("utf-8") + b"\0")
+        for config in [
+            os.path.join(Dir.dot(), "mypy.ini"),
+            os.path.join(Dir.dot(), ".isort.cfg"),
+            os.path.realpath(__file__),
+        ]:
+            try:
+                with open(config, "rb") as f:
+                    sha256.update(hashlib.sha256(f.read()).digest())
+            except FileNotFoundError:
+                sha256.update(b"\0")
+        return sha256.hexdigest()
+
+    # The tidy tools are called through their Python modules when those can
+    # be imported (see _tidy_source), which may be a different install than
+    # the CLIs on the PATH, so it's the modules' versions that count for them.
+    # mypy always runs as a CLI.
+    @staticmethod
+    def _tool_version(tool: str) -> str:
+        if tool != "mypy":
+            try:
+                module = importlib.import_module(tool)
+                return f"{tool} module {module.__version__}"
+            except ImportError:
+                pass
+
+        try:
+            process = subprocess.run(
+                [tool, "--version"], stdout=subprocess.PIPE, text=True
+            )
+        except FileNotFoundError:
+            return f"{tool} missing"
+        return process.stdout.strip()